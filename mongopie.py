@@ -35,46 +35,259 @@
 ################################################
 
 import os
+import sys
+import copy
+import base64
+import time
+import atexit
+import logging
+import threading
+import socket
+import bisect
+import Queue
+import gzip
+import array
+import calendar
+import struct
 from urlparse import urlparse
-from datetime import datetime
-from pymongo import Connection, ASCENDING, DESCENDING
+from datetime import datetime, timedelta
+from pymongo import MongoClient, ASCENDING, DESCENDING, version_tuple
+from pymongo.uri_parser import parse_uri
 from pymongo.cursor import Cursor
+try:
+    from pymongo.cursor import CursorType
+except ImportError:
+    CursorType = None
 from gridfs import GridFS
+from gridfs.grid_file import DEFAULT_CHUNK_SIZE
+from pymongo.errors import BulkWriteError, CollectionInvalid
+from pymongo.errors import AutoReconnect, CursorNotFound
+try:
+    from pymongo.read_concern import ReadConcern
+except ImportError:
+    # pymongo < 3.2
+    ReadConcern = None
+try:
+    from pymongo.write_concern import WriteConcern
+except ImportError:
+    # pymongo < 3
+    WriteConcern = None
+from bson import BSON
+from bson.son import SON
+from bson import json_util
+try:
+    from bson.raw_bson import RawBSONDocument
+    from bson.codec_options import CodecOptions
+except ImportError:
+    # pymongo < 3 always decodes documents
+    RawBSONDocument = None
 from bson.objectid import ObjectId, InvalidId
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from itertools import islice
 
 import pytz
 
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger('mongopie')
+
 def utc_now():
     return datetime.utcnow().replace(tzinfo=pytz.utc)
 
-# Simple signal hub
+# Signal hub
+# Handlers run in one of the modes
+#  * sync: inline in send
+#  * deferred: at the exit of the outermost signal_scope, inline if
+#    no scope is open
+#  * thread: in the signal executor, see set_signal_executor
+#  * batch: once per sender at the exit of the outermost
+#    signal_scope with instances=[...] of all sends in the scope
+signal_modes = ('sync', 'deferred', 'thread', 'batch')
+
+_signal_local = threading.local()
+
+class SignalWorker(object):
+    """ A small pool of daemon threads to run handlers of the
+    thread mode, the threads are started on first submit and again
+    after fork
+    """
+    def __init__(self, size=2):
+        self.size = size
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.tasks = Queue.Queue()
+        for i in xrange(self.size):
+            t = threading.Thread(target=self.run,
+                                 name='mongopie-signal-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def run(self):
+        while True:
+            func, args, kwargs = self.tasks.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('signal handler %r failed', func)
+            finally:
+                self.tasks.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start()
+        self.tasks.put((func, args, kwargs))
+
+    def join(self):
+        """ Wait until the submitted handlers are done
+        """
+        if self.pid == os.getpid():
+            self.tasks.join()
+
+signal_executor = SignalWorker()
+
+def set_signal_executor(executor):
+    """ Set the executor of handlers in thread mode, any object with
+    submit(func, *args, **kwargs), e.g. a concurrent.futures executor
+    """
+    global signal_executor
+    signal_executor = executor
+
+def call_handler(handler, sender, kw):
+    ret = handler(sender, **kw)
+    if ret is not None and is_awaitable(ret):
+        defer_awaitable(ret)
+
+class signal_scope(object):
+    """ Delay the deferred and batch handlers of signals sent in the
+    block until the outermost block exits
+        with signal_scope():
+            for obj in objs:
+                obj.save()
+    """
+    def __enter__(self):
+        depth = getattr(_signal_local, 'depth', 0)
+        if not depth:
+            _signal_local.pending = []
+            _signal_local.batches = OrderedDict()
+        _signal_local.depth = depth + 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _signal_local.depth -= 1
+        if not _signal_local.depth:
+            flush_signals()
+
+def flush_signals():
+    """ Run the handlers delayed by signal_scope so far
+    """
+    pending = getattr(_signal_local, 'pending', None)
+    batches = getattr(_signal_local, 'batches', None)
+    if pending:
+        _signal_local.pending = []
+        for handler, sender, kw in pending:
+            call_handler(handler, sender, kw)
+    if batches:
+        _signal_local.batches = OrderedDict()
+        for (handler, sender), instances in batches.iteritems():
+            call_handler(handler, sender, {'instances': instances})
+
 class SignalSlot(object):
     def __init__(self):
         self.clear()
 
-    def connect(self, sender, handler):
+    def connect(self, sender, handler, mode='sync'):
+        """ Connect handler to the signals of sender and subclasses
+        of sender, return the index to disconnect it
+        """
+        assert mode in signal_modes, 'unknown signal mode %r' % mode
         if sender is None:
             sender = 'root'
-        handlers = self.handlers[sender]
-        handlers.append(handler)
-        return len(handlers) - 1
+        handlers = self.handlers.get(sender)
+        if handlers is None:
+            handlers = self.handlers[sender] = OrderedDict()
+        index = self.next_index.get(sender, 0)
+        self.next_index[sender] = index + 1
+        handlers[index] = (handler, mode)
+        self.lookup_cache.clear()
+        return index
 
     def disconnect(self, sender, index):
         if sender is None:
             sender = 'root'
-        self.handlers[sender][index] = None
+        handlers = self.handlers.get(sender)
+        if handlers is not None:
+            handlers.pop(index, None)
+            if not handlers:
+                del self.handlers[sender]
+        self.lookup_cache.clear()
+
+    def lookup(self, sender):
+        """ Get the handlers of sender and its base classes, cached
+        until the handlers change
+        """
+        found = self.lookup_cache.get(sender)
+        if found is None:
+            found = []
+            for cls in getattr(sender, '__mro__', (sender,)):
+                handlers = self.handlers.get(cls)
+                if handlers:
+                    found.extend(handlers.itervalues())
+            found = self.lookup_cache[sender] = tuple(found)
+        return found
+
+    def has_handlers(self, sender):
+        """ Whether any handler receives the signals of sender, to
+        skip preparing signals nobody receives
+        """
+        if sender is None:
+            sender = 'root'
+        return bool(self.handlers) and bool(self.lookup(sender))
 
     def send(self, sender, **kw):
+        if not self.handlers:
+            return
         if sender is None:
             sender = 'root'
-        handlers = self.handlers[sender]
-        for handler in handlers:
-            if handler:
-                handler(sender, **kw)
+        for handler, mode in self.lookup(sender):
+            if mode == 'sync':
+                call_handler(handler, sender, kw)
+            elif mode == 'thread':
+                signal_executor.submit(call_handler, handler, sender, kw)
+            elif not getattr(_signal_local, 'depth', 0):
+                # No scope to delay to
+                if mode == 'batch' and 'instance' in kw:
+                    kw = {'instances': [kw['instance']]}
+                call_handler(handler, sender, kw)
+            elif mode == 'deferred':
+                _signal_local.pending.append((handler, sender, kw))
+            else:
+                instances = _signal_local.batches.setdefault(
+                    (handler, sender), [])
+                if 'instance' in kw:
+                    instances.append(kw['instance'])
+                else:
+                    instances.extend(kw.get('instances', ()))
 
     def clear(self):
-        self.handlers = defaultdict(list)
+        self.handlers = {}
+        self.next_index = {}
+        self.lookup_cache = {}
 
 class ModelSignal():
     def __init__(self):
@@ -88,6 +301,153 @@ class ModelSignal():
 
 modelsignal = ModelSignal()
 
+# Asyncio support
+# The blocking calls run in an executor of the event loop, asyncio
+# on python 3 or trollius on python 2 is required.
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    class StopAsyncIteration(Exception):
+        pass
+
+async_executor = None
+_async_local = threading.local()
+
+def set_async_executor(executor):
+    """ Set the executor to run blocking calls, None for the
+    default executor of the loop
+    """
+    global async_executor
+    async_executor = executor
+
+def is_awaitable(value):
+    if asyncio is None:
+        return False
+    return asyncio.iscoroutine(value) or isinstance(value, asyncio.Future)
+
+def _ensure_future(value, loop):
+    ensure_future = getattr(asyncio, 'ensure_future', None)
+    if ensure_future is None:
+        ensure_future = getattr(asyncio, 'async')
+    return ensure_future(value, loop=loop)
+
+def _new_future(loop):
+    if hasattr(loop, 'create_future'):
+        return loop.create_future()
+    return asyncio.Future(loop=loop)
+
+def defer_awaitable(value):
+    """ Handle the awaitable returned by an async signal handler.
+    Within run_async it is awaited before the result is set, else
+    it's scheduled on the running loop or run to complete.
+    """
+    pending = getattr(_async_local, 'pending', None)
+    if pending is not None:
+        pending.append(value)
+        return
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None and loop.is_running():
+        _ensure_future(value, loop)
+        return
+    current = loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(value)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(current)
+
+def run_async(func, *args, **kwargs):
+    """ Run the blocking func in the executor, return a future of
+    its result that is done after the awaitables of the async signal
+    handlers are done
+    """
+    if asyncio is None:
+        raise RuntimeError('asyncio or trollius is required')
+    loop = asyncio.get_event_loop()
+    result = _new_future(loop)
+
+    def call():
+        _async_local.pending = []
+        try:
+            return func(*args, **kwargs), _async_local.pending
+        finally:
+            _async_local.pending = None
+
+    def set_result(value, fut):
+        if result.cancelled():
+            return
+        if fut.cancelled():
+            result.cancel()
+        elif fut.exception() is not None:
+            result.set_exception(fut.exception())
+        else:
+            result.set_result(value)
+
+    def on_called(fut):
+        if fut.cancelled() or fut.exception() is not None:
+            set_result(None, fut)
+            return
+        value, pending = fut.result()
+        if not pending:
+            set_result(value, fut)
+            return
+        waiting = asyncio.gather(*[_ensure_future(v, loop)
+                                   for v in pending], loop=loop)
+        waiting.add_done_callback(lambda f: set_result(value, f))
+
+    loop.run_in_executor(async_executor, call).add_done_callback(on_called)
+    return result
+
+class AsyncIterator(object):
+    """ Iterate over an iterable with `async for`, the items are
+    fetched in the executor batch_size at a time
+    """
+    def __init__(self, iterable, batch_size=100):
+        self.iterator = iter(iterable)
+        self.batch_size = batch_size
+        self.buffer = deque()
+        self.exhausted = False
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        loop = asyncio.get_event_loop()
+        if self.buffer:
+            result = _new_future(loop)
+            result.set_result(self.buffer.popleft())
+            return result
+        if self.exhausted:
+            result = _new_future(loop)
+            result.set_exception(StopAsyncIteration())
+            return result
+        return self.fetch()
+
+    def fetch(self):
+        loop = asyncio.get_event_loop()
+        result = _new_future(loop)
+
+        def on_fetched(fut):
+            if fut.exception() is not None:
+                result.set_exception(fut.exception())
+                return
+            self.buffer.extend(fut.result())
+            if len(self.buffer) < self.batch_size:
+                self.exhausted = True
+            if self.buffer:
+                result.set_result(self.buffer.popleft())
+            else:
+                result.set_exception(StopAsyncIteration())
+
+        run_async(lambda: list(islice(self.iterator, self.batch_size))
+                  ).add_done_callback(on_fetched)
+        return result
+
 def merge_condition_dicts(dict1, dict2):
     for k, v2 in dict2.iteritems():
         v1 = dict1.get(k)
@@ -98,36 +458,626 @@ def merge_condition_dicts(dict1, dict2):
         else:
             dict1[k] = v2
 
+_missing = object()
+
+def freeze(value):
+    """ Normalize a value like query conditions into a hashable
+    one, dicts of the same items are equal regardless of order
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v))
+                            for k, v in value.iteritems()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+class PartialObjectError(Exception):
+    """ Writing the fields that are not loaded of an object
+    """
+
 def force_string_keys(datadict, encoding='utf-8'):
     return dict((k.encode(encoding), v)
                 for k, v in datadict.iteritems())
 
 default_db = ('localhost', 27017, 'modeltest')
-dbconn = os.getenv('MONGODB_CONNECTION')
-if dbconn:
-    # We accept url like mongo://127.0.0.1:27017/modeltest' or
-    # 'tcp://127.0.0.1:27017/modeltest'
-    parsed = urlparse(dbconn)
+
+# Objects bound to connections, dropped by reset_connections
+_fs_pool = {}
+_collection_pool = {}
+
+def parse_dburl(url, default_name='modeltest'):
+    """ Parse a database url into a database spec, we accept url like
+    'mongo://127.0.0.1:27017/modeltest', 'tcp://127.0.0.1:27017/modeltest'
+    or a full mongodb:// uri with replica set options like
+    'mongodb://h1:27017,h2:27017/modeltest?replicaSet=rs0'
+    """
+    parsed = urlparse(url)
     if parsed.scheme in ('tcp', 'mongo'):
         host, port = parsed.netloc.split(':')
         dbname = parsed.path[1:]
         port = int(port)
-        default_db = (host, port, dbname)
-        
-def set_defaultdb(host, port, name):
+        return (host, port, dbname)
+    elif parsed.scheme == 'mongodb':
+        dbname = parse_uri(url)['database'] or default_name
+        return (url, dbname)
+    raise ValueError('Unsupported database url %s' % url)
+
+dbconn = os.getenv('MONGODB_CONNECTION')
+if dbconn:
+    default_db = parse_dburl(dbconn)
+
+def set_defaultdb(host, port=None, name=None):
+    """ Set the default database by host, port and name, or by a
+    mongodb:// uri and an optional name
+    """
     global default_db
-    default_db = (host, port, name)
+    if port is None:
+        default_db = parse_dburl(host)
+        if name is not None:
+            default_db = default_db[:-1] + (name,)
+    else:
+        default_db = (host, port, name)
+
+# Options of MongoClient, see configure_connections
+connection_options = {
+    'max_pool_size': 100,
+    'connectTimeoutMS': 20000,
+    'socketTimeoutMS': None,
+    'waitQueueTimeoutMS': None,
+    }
+
+# Options renamed by pymongo 3, either name is accepted
+_renamed_options = {'max_pool_size': 'maxPoolSize'}
+
+def client_options(major=None):
+    """ Get the keyword arguments of MongoClient from
+    connection_options for the major version of pymongo, options set
+    to None are left out
+    """
+    if major is None:
+        major = version_tuple[0]
+    if major >= 3:
+        names = _renamed_options
+    else:
+        names = dict((v, k) for k, v in _renamed_options.iteritems())
+    return dict((names.get(k, k), v)
+                for k, v in connection_options.iteritems()
+                if v is not None)
 
 _conn_pool = {}
+_conn_pid = os.getpid()
+_conn_stats = {'created': 0, 'resets': 0}
+
+def configure_connections(**options):
+    """ Update the options of MongoClient, e.g. max_pool_size (or
+    maxPoolSize), connectTimeoutMS, socketTimeoutMS,
+    waitQueueTimeoutMS, replicaSet and read_preference. Existing
+    connections are dropped.
+    """
+    connection_options.update(options)
+    reset_connections()
+
+def reset_connections():
+    """ Drop all connections and the objects bound to them. The
+    connections are not closed since they may be inherited from the
+    parent process after fork
+    """
+    global _conn_pid
+    _conn_pool.clear()
+    _fs_pool.clear()
+    _collection_pool.clear()
+    _conn_pid = os.getpid()
+    _conn_stats['resets'] += 1
+
+def check_fork():
+    if _conn_pid != os.getpid():
+        # Sockets can not be shared with the parent after fork
+        reset_connections()
+
+def get_client(host, port=None):
+    """ Get the pooled client of host and port, or of a mongodb://
+    uri if port is None
+    """
+    check_fork()
+    key = (host, port)
+    conn = _conn_pool.get(key)
+    if conn is None:
+        options = client_options()
+        if port is None:
+            conn = MongoClient(host, tz_aware=True, **options)
+        else:
+            conn = MongoClient(host, port, tz_aware=True, **options)
+        _conn_pool[key] = conn
+        _conn_stats['created'] += 1
+    return conn
+
 def get_server(host, port, db_name):
-    if (host, port) not in _conn_pool:
-        conn = Connection(host, port, tz_aware=True)
-        _conn_pool[(host, port)] = conn
-    return _conn_pool[(host, port)][db_name]
+    return get_client(host, port)[db_name]
+
+def get_database(database):
+    """ Get the database of a spec, either (host, port, name) or
+    (mongodb uri, name)
+    """
+    if len(database) == 2:
+        uri, db_name = database
+        return get_client(uri)[db_name]
+    return get_server(*database)
+
+def connection_stats():
+    """ Get the stats of the connection pool
+    """
+    clients = {}
+    for (host, port), conn in _conn_pool.items():
+        if port is None:
+            name = host
+        else:
+            name = '%s:%s' % (host, port)
+        clients[name] = {
+            'max_pool_size': getattr(conn, 'max_pool_size', None),
+            'nodes': sorted(getattr(conn, 'nodes', ()) or ()),
+            }
+    return {'pid': _conn_pid,
+            'created': _conn_stats['created'],
+            'resets': _conn_stats['resets'],
+            'clients': clients}
+
+slow_logger = logging.getLogger('mongopie.slow')
+
+def normalize_query(spec):
+    """ Replace the values of a query with '?' so that queries of
+    the same shape look the same
+    """
+    if isinstance(spec, dict):
+        return dict((k, normalize_query(v)) for k, v in spec.iteritems())
+    elif (isinstance(spec, (list, tuple)) and spec and
+          all(isinstance(v, dict) for v in spec)):
+        # Clauses of $or, $and and $nor
+        return [normalize_query(v) for v in spec]
+    return '?'
+
+def find_caller():
+    """ Get the location of the nearest frame outside mongopie
+    """
+    here = os.path.splitext(__file__)[0]
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if os.path.splitext(code.co_filename)[0] != here:
+            return '%s:%d in %s' % (code.co_filename, frame.f_lineno,
+                                    code.co_name)
+        frame = frame.f_back
+    return None
+
+def count_result(op, result):
+    """ Get the number of documents and the documents of a result
+    """
+    if result is None:
+        return 0, ()
+    if isinstance(result, dict):
+        if op in ('update', 'remove'):
+            return result.get('n', 0), ()
+        if op == 'bulk':
+            return sum(result.get(k, 0) or 0
+                       for k in ('nInserted', 'nUpserted',
+                                 'nModified', 'nRemoved')), ()
+        return 1, (result,)
+    if isinstance(result, list):
+        return len(result), [r for r in result if isinstance(r, dict)]
+    if isinstance(result, (int, long, bool)):
+        # Counts and acknowledgements
+        return 0, ()
+    return 1, ()
+
+class QueryStats(object):
+    """ Counters and latency histogram of an operation of a model
+    """
+    def __init__(self, buckets):
+        self.calls = 0
+        self.errors = 0
+        self.time = 0.0
+        self.max_time = 0.0
+        self.docs = 0
+        self.bytes = 0
+        self.histogram = [0] * (len(buckets) + 1)
+
+    def to_dict(self, buckets):
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'time': self.time,
+                'max_time': self.max_time,
+                'docs': self.docs,
+                'bytes': self.bytes,
+                'histogram': zip(buckets + (float('inf'),),
+                                 self.histogram)}
+
+class Instrumentation(object):
+    """ Count the calls, time, documents and bytes of every database
+    operation by model and operation, and log slow operations. Enable
+    it by enable_instrumentation, sinks are called with
+    (model, op, elapsed, docs, nbytes, error) on every operation.
+    """
+    # Upper bounds of the latency histogram in seconds
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, slow_threshold=0.1, explain_slow=False,
+                 slow_log_size=100, measure_bytes=True,
+                 buckets=None, sinks=None):
+        self.slow_threshold = slow_threshold
+        self.explain_slow = explain_slow
+        self.measure_bytes = measure_bytes
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.sinks = list(sinks or ())
+        self.stats = {}
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.slow_queries.clear()
+
+    def measure(self, docs):
+        if not self.measure_bytes:
+            return 0
+        return sum(len(BSON.encode(d)) for d in docs)
+
+    def record(self, cls, op, elapsed, docs=0, nbytes=0, error=False,
+               spec=None, collection=None):
+        name = cls.__name__
+        key = (name, op)
+        with self.lock:
+            st = self.stats.get(key)
+            if st is None:
+                st = self.stats[key] = QueryStats(self.buckets)
+            st.calls += 1
+            st.time += elapsed
+            st.max_time = max(st.max_time, elapsed)
+            st.docs += docs
+            st.bytes += nbytes
+            if error:
+                st.errors += 1
+            st.histogram[bisect.bisect_left(self.buckets, elapsed)] += 1
+        if (self.slow_threshold is not None and
+            elapsed >= self.slow_threshold):
+            self.log_slow(name, op, elapsed, spec, collection)
+        for sink in self.sinks:
+            try:
+                sink(name, op, elapsed, docs, nbytes, error)
+            except Exception:
+                logger.exception('failed to send stats to %r', sink)
+
+    def log_slow(self, name, op, elapsed, spec, collection):
+        entry = {'model': name,
+                 'op': op,
+                 'time': elapsed,
+                 'query': normalize_query(spec) if spec else None,
+                 'caller': find_caller(),
+                 'at': utc_now()}
+        if (self.explain_slow and collection is not None and
+            op in ('find', 'find_one', 'count')):
+            try:
+                entry['explain'] = collection.find(spec or {}).explain()
+            except Exception:
+                logger.exception('failed to explain %r', spec)
+        self.slow_queries.append(entry)
+        slow_logger.warning('slow %s.%s %.1fms query=%r at %s',
+                            name, op, elapsed * 1000,
+                            entry['query'], entry['caller'])
+
+    def call(self, cls, op, func, *args, **kwargs):
+        """ Call func and record it as op of cls
+        """
+        spec = kwargs.pop('_spec', None)
+        collection = kwargs.pop('_collection', None)
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except:
+            self.record(cls, op, time.time() - start, error=True,
+                        spec=spec, collection=collection)
+            raise
+        elapsed = time.time() - start
+        ndocs, docs = count_result(op, result)
+        self.record(cls, op, elapsed, ndocs, self.measure(docs),
+                    spec=spec, collection=collection)
+        return result
+
+    def report(self):
+        """ Get the stats as a dict of 'Model.op' -> counters
+        """
+        with self.lock:
+            return dict(('%s.%s' % key, st.to_dict(self.buckets))
+                        for key, st in self.stats.iteritems())
+
+    def prometheus_text(self, prefix='mongopie'):
+        """ Render the stats in the Prometheus text exposition format
+        """
+        lines = ['# TYPE %s_query_seconds histogram' % prefix]
+        counters = ('calls', 'errors', 'docs', 'bytes')
+        with self.lock:
+            items = sorted(self.stats.items())
+        for (name, op), st in items:
+            labels = 'model="%s",op="%s"' % (name, op)
+            total = 0
+            for bound, n in zip(self.buckets + (float('inf'),),
+                                st.histogram):
+                total += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_query_seconds_bucket{%s,le="%s"} %d' %
+                             (prefix, labels, le, total))
+            lines.append('%s_query_seconds_sum{%s} %f' %
+                         (prefix, labels, st.time))
+            lines.append('%s_query_seconds_count{%s} %d' %
+                         (prefix, labels, st.calls))
+            for counter in counters:
+                lines.append('%s_query_%s_total{%s} %d' %
+                             (prefix, counter, labels,
+                              getattr(st, counter)))
+        return '\n'.join(lines) + '\n'
+
+class StatsdSink(object):
+    """ Send the stats of every operation to statsd over UDP
+    """
+    def __init__(self, host='127.0.0.1', port=8125, prefix='mongopie'):
+        self.addr = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, model, op, elapsed, docs, nbytes, error):
+        name = '%s.%s.%s' % (self.prefix, model, op)
+        lines = ['%s.time:%f|ms' % (name, elapsed * 1000),
+                 '%s.docs:%d|c' % (name, docs)]
+        if nbytes:
+            lines.append('%s.bytes:%d|c' % (name, nbytes))
+        if error:
+            lines.append('%s.errors:1|c' % name)
+        try:
+            self.sock.sendto('\n'.join(lines), self.addr)
+        except socket.error:
+            pass
+
+class InstrumentedCursor(object):
+    """ A cursor recording the time and documents of its iteration
+    as one find operation, see Instrumentation
+    """
+    def __init__(self, cursor, cls, instr, spec, collection):
+        self.cursor = cursor
+        self.cls = cls
+        self.instr = instr
+        self.spec = spec
+        self.collection = collection
+        self.elapsed = 0.0
+        self.docs = 0
+        self.bytes = 0
+        self.started = False
+        self.finished = False
+
+    def __getattr__(self, name):
+        attr = getattr(self.cursor, name)
+        if not callable(attr):
+            return attr
+        def chained(*args, **kwargs):
+            ret = attr(*args, **kwargs)
+            if ret is self.cursor:
+                return self
+            return ret
+        return chained
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self.started = True
+        start = time.time()
+        try:
+            doc = self.cursor.next()
+        except StopIteration:
+            self.elapsed += time.time() - start
+            self.finish()
+            raise
+        self.elapsed += time.time() - start
+        self.docs += 1
+        if self.instr.measure_bytes:
+            self.bytes += len(BSON.encode(doc))
+        return doc
+
+    def finish(self):
+        # Cursors only counted or indexed are not finds
+        if self.started and not self.finished:
+            self.finished = True
+            self.instr.record(self.cls, 'find', self.elapsed,
+                              self.docs, self.bytes, spec=self.spec,
+                              collection=self.collection)
+
+    def close(self):
+        self.finish()
+        self.cursor.close()
+
+    def __del__(self):
+        # Cursors abandoned before the end, e.g. a probe of limit(1)
+        try:
+            self.finish()
+        except Exception:
+            pass
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self.cursor.__getitem__(index)
+            return self
+        return self.instr.call(self.cls, 'find_one',
+                               self.cursor.__getitem__, index,
+                               _spec=self.spec,
+                               _collection=self.collection)
+
+    def count(self, *args, **kwargs):
+        return self.instr.call(self.cls, 'count', self.cursor.count,
+                               *args, _spec=self.spec,
+                               _collection=self.collection, **kwargs)
+
+class InstrumentedBulk(object):
+    def __init__(self, bulk, cls, instr):
+        self.bulk = bulk
+        self.cls = cls
+        self.instr = instr
+
+    def __getattr__(self, name):
+        return getattr(self.bulk, name)
+
+    def execute(self, *args, **kwargs):
+        return self.instr.call(self.cls, 'bulk', self.bulk.execute,
+                               *args, **kwargs)
+
+class InstrumentedCollection(object):
+    """ A proxy of a collection recording the operations of a model,
+    returned by Model.collection while instrumentation is enabled
+    """
+    timed_methods = frozenset(['find_one', 'count', 'save', 'insert',
+                               'update', 'remove', 'find_and_modify',
+                               'aggregate', 'distinct'])
+    def __init__(self, col, cls, instr):
+        self.col = col
+        self.cls = cls
+        self.instr = instr
+
+    def __getattr__(self, name):
+        attr = getattr(self.col, name)
+        if name not in self.timed_methods:
+            return attr
+        def timed(*args, **kwargs):
+            if args and isinstance(args[0], dict):
+                spec = args[0]
+            else:
+                spec = kwargs.get('query') or kwargs.get('spec')
+            return self.instr.call(self.cls, name, attr, *args,
+                                   _spec=spec, _collection=self.col,
+                                   **kwargs)
+        return timed
+
+    def find(self, *args, **kwargs):
+        spec = args[0] if args else kwargs.get('spec')
+        return InstrumentedCursor(self.col.find(*args, **kwargs),
+                                  self.cls, self.instr, spec, self.col)
+
+    def initialize_ordered_bulk_op(self):
+        return InstrumentedBulk(self.col.initialize_ordered_bulk_op(),
+                                self.cls, self.instr)
+
+    def initialize_unordered_bulk_op(self):
+        return InstrumentedBulk(self.col.initialize_unordered_bulk_op(),
+                                self.cls, self.instr)
+
+class InstrumentedGridFS(object):
+    """ A proxy of GridFS recording the operations of a model
+    """
+    timed_methods = frozenset(['get', 'put', 'delete', 'exists'])
+    def __init__(self, fs, cls, instr):
+        self.fs = fs
+        self.cls = cls
+        self.instr = instr
+
+    def __getattr__(self, name):
+        attr = getattr(self.fs, name)
+        if name not in self.timed_methods:
+            return attr
+        def timed(*args, **kwargs):
+            return self.instr.call(self.cls, 'gridfs_' + name, attr,
+                                   *args, **kwargs)
+        return timed
+
+instrumentation = None
+def enable_instrumentation(**options):
+    """ Record every database operation, options are passed to
+    Instrumentation, return the instrumentation
+    """
+    global instrumentation
+    instrumentation = Instrumentation(**options)
+    return instrumentation
+
+def disable_instrumentation():
+    global instrumentation
+    instrumentation = None
+
+class Page(list):
+    """ A page of keyset pagination, see CursorWrapper.seek
+    """
+    next_token = None
+    prev_token = None
+
+def encode_seek_token(backward, keys, values):
+    data = BSON.encode({'b': backward, 'k': keys, 'v': values})
+    return base64.urlsafe_b64encode(data)
+
+def decode_seek_token(token, keys):
+    try:
+        data = BSON(base64.urlsafe_b64decode(str(token))).decode()
+    except Exception:
+        raise ValueError('Invalid seek token')
+    if data.get('k') != keys:
+        raise ValueError('Seek token of different sort orders')
+    return data['b'], data['v']
+
+def get_path(doc, key):
+    """ Get the value of a dotted key of a document
+    """
+    for part in key.split('.'):
+        if doc is None:
+            return None
+        doc = doc.get(part)
+    return doc
 
+def make_seek_condition(orders, values, backward=False):
+    """ Make the condition of rows after values in orders, or
+    before values if backward
+    """
+    clauses = []
+    for i, (key, order) in enumerate(orders):
+        prefix = dict((k, v) for (k, _), v in zip(orders[:i], values))
+        value = values[i]
+        if (order == ASCENDING) != backward:
+            # null and missing values sort first
+            if value is None:
+                conds = [{'$ne': None}]
+            else:
+                conds = [{'$gt': value}]
+        else:
+            if value is None:
+                conds = []
+            else:
+                conds = [{'$lt': value}, None]
+        for cond in conds:
+            clause = dict(prefix)
+            clause[key] = cond
+            clauses.append(clause)
+    if not clauses:
+        # Nothing is beyond the first possible row
+        return {'_id': {'$in': []}}
+    if len(clauses) == 1:
+        return clauses[0]
+    return {'$or': clauses}
 
 class CursorWrapper:
     index=None
+    prefetch_fields = ()
+    prefetch_batch = 100
+    only_fields = None
+    defer_fields = ()
+    batch_deferred = False
+    _result_cache = None
+    _count_cache = None
+    hint_index = None
+    # Cursor options, see batch_size, limit, no_cursor_timeout,
+    # max_time_ms, read_concern and resumable
+    cursor_batch_size = None
+    limit_count = None
+    no_timeout = False
+    max_time = None
+    read_concern_level = None
+    resume_retries = 0
     def __init__(self, cls, conditions=None, orders=None, index=None):
         if conditions:
             self.conditions = conditions
@@ -143,74 +1093,1035 @@ class CursorWrapper:
             self.index = index
         self.cls = cls
 
-    def get_cursor(self):
-        col = self.cls.collection()
-        cursor = col.find(self.conditions)
+    def clone(self, **kwargs):
+        """ Copy the wrapper with some settings replaced
+        """
+        wrapper = copy.copy(self)
+        wrapper._result_cache = None
+        wrapper._count_cache = None
+        for k, v in kwargs.iteritems():
+            setattr(wrapper, k, v)
+        return wrapper
+
+    def invalidate(self):
+        """ Drop the cached results and counts, the query will be
+        executed again on next access
+        """
+        self._result_cache = None
+        self._count_cache = None
+        for with_limit_and_skip in (False, True):
+            count_cache.pop(self.count_key(with_limit_and_skip), None)
+
+    def get_cursor(self, col=None, projection=None):
+        if col is None:
+            col = self.cls.collection(read=True, raw=self.cls.lazy_bson)
+        if self.read_concern_level is not None:
+            col = col.with_options(
+                read_concern=ReadConcern(self.read_concern_level))
+        if projection is None:
+            projection = self.get_projection()
+        kwargs = {}
+        if self.no_timeout:
+            if version_tuple[0] < 3:
+                kwargs['timeout'] = False
+            else:
+                kwargs['no_cursor_timeout'] = True
+        cursor = col.find(self.conditions, projection, **kwargs)
         if self.orders:
             cursor = cursor.sort(self.orders)
+        if self.hint_index is not None:
+            cursor = cursor.hint(self.hint_index)
+        if query_check_mode is not None:
+            check_query(self.cls, cursor, self.conditions, self.orders)
         if self.index:
             cursor = cursor.__getitem__(self.index)
+        if self.limit_count is not None:
+            limit = self.limit_count
+            index = self.index
+            if isinstance(index, slice) and index.stop is not None:
+                limit = min(limit, index.stop - (index.start or 0))
+            cursor = cursor.limit(limit)
+        if self.cursor_batch_size is not None:
+            cursor = cursor.batch_size(self.cursor_batch_size)
+        if self.max_time is not None:
+            cursor = cursor.max_time_ms(self.max_time)
 
         return cursor
 
+    def batch_size(self, size):
+        """ Fetch size documents per round trip
+        """
+        return self.clone(cursor_batch_size=size)
+
+    def limit(self, count):
+        """ Limit the number of results, besides slicing
+        """
+        return self.clone(limit_count=count)
+
+    def no_cursor_timeout(self, flag=True):
+        """ Keep the cursor alive on the server while idle, for long
+        jobs processing each batch slowly
+        """
+        return self.clone(no_timeout=flag)
+
+    def max_time_ms(self, ms):
+        """ Abort the query on the server after ms milliseconds
+        """
+        return self.clone(max_time=ms)
+
+    def read_concern(self, level):
+        """ Read with a read concern level like 'majority', requires
+        pymongo >= 3.2
+        """
+        assert ReadConcern is not None, 'read concern requires pymongo >= 3.2'
+        return self.clone(read_concern_level=level)
+
+    def resumable(self, retries=3):
+        """ Restart the query after the last document read when the
+        cursor is lost or the connection fails, up to retries times
+        in a row. _id is added to the sort orders to locate the
+        last document.
+        """
+        return self.clone(resume_retries=retries)
+
+    def iter_documents(self):
+        """ Iterate over the raw documents of the results
+        """
+        if not self.resume_retries:
+            return self.get_cursor()
+        return self.iter_resumable()
+
+    def iter_resumable(self):
+        orders = list(self.orders)
+        if '_id' not in [key for key, _ in orders]:
+            orders.append(('_id', ASCENDING))
+        keys = [key for key, _ in orders]
+        projection = self.get_projection()
+        if projection:
+            # Sort keys are needed to resume
+            for key in keys:
+                if 0 in projection.values():
+                    projection.pop(key, None)
+                else:
+                    projection[key] = 1
+        index = self.index
+        start = 0
+        stop = None
+        if isinstance(index, slice):
+            start = index.start or 0
+            stop = index.stop
+        if self.limit_count is not None:
+            stop = min(stop, start + self.limit_count) \
+                if stop is not None else start + self.limit_count
+        wrapper = self.clone(orders=orders, index=None, limit_count=None)
+        read = 0
+        failures = 0
+        last = None
+        while True:
+            w = wrapper
+            skip = start
+            if last is not None:
+                # The skipped rows are before last
+                skip = 0
+                predicate = make_seek_condition(orders, last)
+                conditions = predicate
+                if self.conditions:
+                    conditions = {'$and': [self.conditions, predicate]}
+                w = wrapper.clone(conditions=conditions)
+            if stop is not None:
+                remaining = stop - start - read
+                if remaining <= 0:
+                    return
+                w = w.clone(index=slice(skip, skip + remaining))
+            elif skip:
+                w = w.clone(index=slice(skip, None))
+            try:
+                for datadict in w.get_cursor(projection=projection):
+                    last = [get_path(datadict, key) for key in keys]
+                    read += 1
+                    failures = 0
+                    yield datadict
+                return
+            except (AutoReconnect, CursorNotFound), e:
+                failures += 1
+                if failures > self.resume_retries:
+                    raise
+                logger.warning('resume %s after %d documents: %s',
+                               self.cls.__name__, read, e)
+                time.sleep(min(0.1 * 2 ** failures, 5))
+
+    def iter_batches(self, size=1000):
+        """ Iterate over lists of at most size objects, to process
+        and write them in chunks
+        """
+        wrapper = self
+        if self.cursor_batch_size is None:
+            wrapper = self.clone(cursor_batch_size=size)
+        return iter_chunks(wrapper.iterator(), size)
+
+    def hint(self, index):
+        """ Force the index of the query, index is an Index, a name
+        of an index, or field names like Index
+        """
+        if isinstance(index, (list, tuple)):
+            index = Index(*index)
+        if isinstance(index, Index):
+            index = index.get_keys(self.cls)
+        return self.clone(hint_index=index)
+
     def __len__(self):
-        return self.get_cursor().count()
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return self.get_count(with_limit_and_skip=(
+            self.index is not None or self.limit_count is not None))
 
     def __nonzero__(self):
-        return self.get_cursor().count() > 0
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        if self._count_cache:
+            # The unsliced count only tells if a slice is empty
+            bounded = (self.index is not None or
+                       self.limit_count is not None)
+            if bounded in self._count_cache:
+                return self._count_cache[bounded] > 0
+            if self._count_cache.get(False) == 0:
+                return False
+        index = self.index
+        if (isinstance(index, slice) and index.stop is not None and
+            index.stop <= (index.start or 0)):
+            return False
+        # Probe the existence of one document instead of counting
+        cursor = self.get_cursor().limit(1)
+        return any(True for _ in cursor)
 
     def __repr__(self):
         return repr(list(self))
 
     def __iter__(self):
+        if self._result_cache is not None:
+            return iter(self._result_cache)
+        return self.iter_and_cache()
+
+    def iter_and_cache(self):
+        results = []
+        for obj in self.iterator():
+            results.append(obj)
+            yield obj
+        self._result_cache = results
+
+    def iterator(self):
+        """ Iterate over the results without caching them, for
+        large results that are walked only once
+        """
         def cursor_iter():
-            cursor = self.get_cursor()
-            for datadict in cursor:
-                yield self.cls.get_from_data(datadict)
+            cursor = self.iter_documents()
+            if not (self.prefetch_fields or self.batch_deferred):
+                for datadict in cursor:
+                    yield self.hydrate(datadict)
+                return
+            for chunk in iter_chunks(cursor, self.prefetch_batch):
+                objs = [self.hydrate(datadict) for datadict in chunk]
+                if self.prefetch_fields:
+                    self.cls.prefetch_related(objs, *self.prefetch_fields)
+                if self.batch_deferred:
+                    for obj in objs:
+                        obj._deferred_batch = objs
+                for obj in objs:
+                    yield obj
         return iter(cursor_iter())
 
+    def __aiter__(self):
+        return AsyncIterator(self)
+
+    def alist(self):
+        """ Get a future of the list of all results
+        """
+        return run_async(list, self)
+
+    def acount(self):
+        return run_async(self.count)
+
+    def hydrate(self, datadict):
+        obj = self.cls.get_from_data(datadict)
+        deferred = self.get_deferred()
+        if deferred:
+            obj._deferred = set(deferred)
+        return obj
+
+    def only(self, *fieldnames, **kwargs):
+        """ Load only fieldnames of the results, other fields are
+        deferred. See defer
+        """
+        only_fields = tuple(self.only_fields or ()) + fieldnames
+        return self.clone(
+            only_fields=only_fields,
+            batch_deferred=kwargs.get('batch', self.batch_deferred))
+
+    def defer(self, *fieldnames, **kwargs):
+        """ Do not load fieldnames of the results until they are
+        accessed. The deferred fields of all objects in the same
+        batch of results are loaded together if batch is True
+        """
+        return self.clone(
+            defer_fields=self.defer_fields + fieldnames,
+            batch_deferred=kwargs.get('batch', self.batch_deferred))
+
+    def get_deferred(self):
+        """ Get the names of the fields not loaded
+        """
+        deferred = set(self.defer_fields)
+        if self.only_fields is not None:
+            deferred.update(fieldname for fieldname in self.cls.field_map
+                            if fieldname not in self.only_fields)
+        deferred.discard('id')
+        return deferred
+
+    def get_projection(self):
+        deferred = self.get_deferred()
+        if not deferred:
+            return None
+        field_map = self.cls.field_map
+        if self.only_fields is not None:
+            return dict((field_map[fieldname].get_key(), 1)
+                        for fieldname in self.only_fields
+                        if fieldname not in deferred)
+        return dict((field_map[fieldname].get_key(), 0)
+                    for fieldname in deferred)
+
+    def prefetch(self, *fieldnames, **kwargs):
+        """ Resolve the references of fieldnames in batches of
+        results, with one query per referenced class per batch.
+        A fieldname is either a ReferenceField or a reference of
+        the children as 'children.fieldname'.
+        """
+        batch_size = kwargs.pop('batch_size', self.prefetch_batch)
+        return self.clone(
+            prefetch_fields=self.prefetch_fields + fieldnames,
+            prefetch_batch=batch_size)
+
     def paginate(self, page=1, count=20):
         if page < 1:
             page = 1
         index = slice((page - 1) * count, page * count)
         return self.__getitem__(index)
 
+    def seek(self, token=None, count=20):
+        """ Keyset pagination, a page is located by the sort key
+        values of the row next to it instead of skipping rows.
+        token is the next_token or prev_token of a Page returned by
+        seek, None for the first page. _id is added to the sort orders
+        to break ties.
+        """
+        orders = list(self.orders)
+        if '_id' not in [key for key, _ in orders]:
+            orders.append(('_id', ASCENDING))
+        keys = [key for key, _ in orders]
+
+        backward = False
+        conditions = self.conditions
+        if token is not None:
+            backward, values = decode_seek_token(token, keys)
+            predicate = make_seek_condition(orders, values, backward)
+            if conditions:
+                conditions = {'$and': [conditions, predicate]}
+            else:
+                conditions = predicate
+        if backward:
+            orders = [(key, -order) for key, order in orders]
+
+        wrapper = self.clone(conditions=conditions, orders=orders,
+                             index=slice(0, count + 1))
+        objs = list(wrapper.iterator())
+        more = len(objs) > count
+        objs = objs[:count]
+        if backward:
+            objs.reverse()
+
+        page = Page(objs)
+        if objs:
+            first = [self.cls.get_key_value(objs[0], key) for key in keys]
+            last = [self.cls.get_key_value(objs[-1], key) for key in keys]
+            if backward:
+                has_prev, has_next = more, True
+            else:
+                has_prev, has_next = token is not None, more
+            if has_prev:
+                page.prev_token = encode_seek_token(True, keys, first)
+            if has_next:
+                page.next_token = encode_seek_token(False, keys, last)
+        return page
+
     def __getitem__(self, index):
         if isinstance(index, slice):
-            return CursorWrapper(
-                self.cls,
-                conditions=self.conditions,
-                orders=self.orders,
-                index=index)
+            return self.clone(index=index)
         else:
             assert isinstance(index, (int, long))
             data = self.get_cursor().__getitem__(index)
-            assert isinstance(data, dict)
-            return self.cls.get_from_data(data)
+            assert data is not None
+            return self.hydrate(data)
 
     def count(self):
-        return self.get_cursor().count()
+        return self.get_count()
+
+    def get_count(self, with_limit_and_skip=False):
+        """ Count the results, the count is cached on the wrapper,
+        and for count_cache_ttl seconds across wrappers of the same
+        conditions if the model sets count_cache_ttl
+        """
+        if self._count_cache is None:
+            self._count_cache = {}
+        elif with_limit_and_skip in self._count_cache:
+            return self._count_cache[with_limit_and_skip]
+
+        ttl = self.cls.count_cache_ttl
+        if ttl:
+            key = self.count_key(with_limit_and_skip)
+            n = count_cache.get(key)
+            if n is None:
+                n = self.get_cursor().count(
+                    with_limit_and_skip=with_limit_and_skip)
+                count_cache.set(key, n, ttl=ttl)
+        else:
+            n = self.get_cursor().count(
+                with_limit_and_skip=with_limit_and_skip)
+        self._count_cache[with_limit_and_skip] = n
+        return n
+
+    def count_key(self, with_limit_and_skip=False):
+        index = self.index
+        if with_limit_and_skip and isinstance(index, slice):
+            index = (index.start, index.stop, self.limit_count)
+        elif with_limit_and_skip:
+            index = self.limit_count
+        else:
+            index = None
+        return (self.cls.col_name, freeze(self.conditions), index)
 
     def sort(self, *fields):
         cols = self.cls.make_sort(fields)
-        return CursorWrapper(self.cls,
-                             conditions=self.conditions,
-                             orders=self.orders + cols
-                             )
+        return self.clone(orders=self.orders + cols,
+                          index=None)
 
     def find(self, **kwargs):
         kwargs = self.cls.filter_condition(kwargs)
         conditions = self.conditions.copy()
         merge_condition_dicts(conditions, kwargs)
-        return CursorWrapper(self.cls,
-                             conditions=conditions,
-                             orders=self.orders)
+        return self.clone(conditions=conditions,
+                          index=None)
+
+    def export(self, stream, format='bson', compress=False,
+               files_stream=None):
+        """ Write the raw documents of the results to stream without
+        hydrating them, in the order of the wrapper. format is bson
+        (like mongodump) or jsonl, the output is gzipped if compress
+        is True. The GridFS files of FileFields are written to
+        files_stream if given. Return the number of documents.
+        """
+        assert format in export_formats, 'unknown format %r' % format
+        col = self.cls.collection(read=True)
+        if format == 'bson' and RawBSONDocument is not None:
+            # Write the bytes from the server without decoding
+            col = col.with_options(codec_options=CodecOptions(
+                    document_class=RawBSONDocument))
+        if compress:
+            stream = gzip.GzipFile(fileobj=stream, mode='wb')
+        file_keys = [f.get_key() for f in self.cls.fields
+                     if isinstance(f, FileField)]
+        exporter = None
+        if files_stream is not None and file_keys:
+            exporter = FileExporter(self.cls, files_stream, format,
+                                    compress)
+        count = 0
+        try:
+            for doc in self.get_cursor(col):
+                stream.write(encode_document(doc, format))
+                count += 1
+                if exporter is not None:
+                    for key in file_keys:
+                        exporter.export(doc.get(key))
+        finally:
+            if compress:
+                stream.close()
+            if exporter is not None:
+                exporter.close()
+        return count
+
+    def iter_columns(self, *fieldnames, **kwargs):
+        """ Read fields of the results into columns without making
+        objects, yield a dict of fieldname -> column per batch_size
+        documents. Columns are numpy arrays typed by the fields, e.g.
+        int64 of IntegerField, or array.array if numpy is missing.
+        Missing values are the default of the field, NaN of floats
+        and NaT of datetimes.
+        """
+        batch_size = kwargs.get('batch_size', 10000)
+        cls = self.cls
+        columns = []
+        projection = {'_id': 0}
+        for name in fieldnames:
+            if name == 'id':
+                # The ObjectIdField made by Model.initialize
+                field = cls.fields[0]
+            else:
+                field = cls.field_map[name]
+            key = field.get_key()
+            default = field.default_value
+            if default is None and field.column_type == 'float64':
+                default = float('nan')
+            elif default is None and field.column_type in ('int64', 'bool'):
+                default = 0
+            columns.append((name, key, field.column_type, default))
+            projection[key] = 1
+        col = cls.collection(read=True)
+        cursor = self.get_cursor(col, projection)
+        cursor.batch_size(min(batch_size, 10000))
+        for chunk in iter_chunks(cursor, batch_size):
+            batch = {}
+            for name, key, column_type, default in columns:
+                values = [d.get(key, default) for d in chunk]
+                if column_type in ('int64', 'bool', 'float64'):
+                    values = [default if v is None else v for v in values]
+                batch[name] = make_column(column_type, values)
+            yield batch
+
+    def to_columns(self, *fieldnames, **kwargs):
+        """ Read fields of all results into columns, see iter_columns
+        """
+        chunks = defaultdict(list)
+        for batch in self.iter_columns(*fieldnames, **kwargs):
+            for name, column in batch.iteritems():
+                chunks[name].append(column)
+        columns = {}
+        for name in fieldnames:
+            column = concat_columns(chunks[name])
+            if column is None:
+                column_type = (self.cls.field_map[name].column_type
+                               if name != 'id' else None)
+                column = make_column(column_type, [])
+            columns[name] = column
+        return columns
+
+    def get_pipeline(self):
+        """ Get the stages of the conditions, orders and index of the
+        wrapper to start an aggregation pipeline
+        """
+        pipeline = []
+        if self.conditions:
+            pipeline.append({'$match': self.conditions})
+        if self.orders:
+            pipeline.append({'$sort': SON(self.orders)})
+        index = self.index
+        if isinstance(index, slice):
+            if index.start:
+                pipeline.append({'$skip': index.start})
+            if index.stop is not None:
+                pipeline.append({'$limit': index.stop - (index.start or 0)})
+        return pipeline
+
+    def aggregate(self, *stages, **kwargs):
+        """ Run the stages after the pipeline of the wrapper, stages
+        use db keys, see Model.get_field_key. The results are streamed
+        and hydrated into objects if hydrate is True, other kwargs are
+        passed to collection.aggregate
+        """
+        hydrate = kwargs.pop('hydrate', False)
+        batch_size = kwargs.pop('batch_size', None)
+        kwargs.setdefault('allowDiskUse', True)
+        if version_tuple[0] < 3:
+            # A cursor instead of a single document of 16M at most
+            cursor = kwargs.setdefault('cursor', {})
+            if batch_size:
+                cursor['batchSize'] = batch_size
+        elif batch_size:
+            kwargs['batchSize'] = batch_size
+        col = self.cls.collection(read=True)
+        result = col.aggregate(self.get_pipeline() + list(stages),
+                               **kwargs)
+        if isinstance(result, dict):
+            result = result['result']
+        if hydrate:
+            return (self.hydrate(datadict) for datadict in result)
+        return iter(result)
+
+    def group_by(self, *fieldnames, **accumulators):
+        """ Group the results by fields, accumulators are name='count'
+        or name=(op, fieldname) with op one of sum, avg, min, max,
+        first, last, push and addToSet, e.g.
+            Vote.find(votee='Jack').group_by('tag', votes='count')
+        yields dicts like {'tag': 'Food', 'votes': 1}. _sort orders the
+        groups by names of fields or accumulators, _limit limits them.
+        """
+        sort = accumulators.pop('_sort', None)
+        limit = accumulators.pop('_limit', None)
+        get_key = self.cls.get_field_key
+        if not fieldnames:
+            group_id = None
+        elif len(fieldnames) == 1:
+            group_id = '$' + get_key(fieldnames[0])
+        else:
+            group_id = SON((name, '$' + get_key(name))
+                           for name in fieldnames)
+        group = SON([('_id', group_id)])
+        for name, acc in accumulators.iteritems():
+            if acc == 'count':
+                group[name] = {'$sum': 1}
+            else:
+                op, value = acc
+                if isinstance(value, basestring):
+                    value = '$' + get_key(value)
+                group[name] = {'$' + op: value}
+        stages = [{'$group': group}]
+        if sort:
+            if isinstance(sort, basestring):
+                sort = [sort]
+            orders = SON()
+            for name in sort:
+                order = ASCENDING
+                if name.startswith('-'):
+                    name = name[1:]
+                    order = DESCENDING
+                if name in fieldnames:
+                    name = len(fieldnames) == 1 and '_id' or '_id.' + name
+                orders[name] = order
+            stages.append({'$sort': orders})
+        if limit:
+            stages.append({'$limit': limit})
+        for datadict in self.aggregate(*stages):
+            group_id = datadict.pop('_id')
+            if len(fieldnames) == 1:
+                datadict[fieldnames[0]] = group_id
+            elif fieldnames:
+                datadict.update(group_id)
+            yield datadict
+
+    def update(self, set=None, unset=None, inc=None, push=None,
+               add_to_set=None, pull=None, set_on_insert=None,
+               upsert=False):
+        """ Update all documents of the conditions in one round trip
+        without loading them, see Model.make_update for the
+        arguments. Only the affected objects are evicted from the
+        object cache. Return an UpdateResult.
+        """
+        assert self.index is None, 'can not update a slice'
+        cls = self.cls
+        update = cls.make_update(set=set, unset=unset, inc=inc,
+                                 push=push, add_to_set=add_to_set,
+                                 pull=pull, set_on_insert=set_on_insert)
+        if not update:
+            return UpdateResult()
+        col = cls.collection()
+        objids = cls.condition_ids(self.conditions)
+        evict_all = False
+        if (objids is None and cls.use_obj_cache and
+            (len(cls.obj_cache) or invalidation_bus is not None)):
+            # Find the ids to evict, evict the whole class if there
+            # are more than the cache can hold
+            limit = cls.obj_cache.max_size or 10000
+            objids = [d['_id'] for d in
+                      col.find(self.conditions, ['_id']).limit(limit + 1)]
+            if len(objids) > limit:
+                evict_all = True
+        ret = col.update(self.conditions, update,
+                         multi=True, upsert=upsert)
+        self.invalidate()
+        if evict_all:
+            cls.invalidate_cache()
+        elif objids:
+            cls.invalidate_cache(objids)
+        ret = ret or {}
+        upserted_id = ret.get('upserted')
+        matched = ret.get('n', 0)
+        if upserted_id is not None:
+            matched -= 1
+        return UpdateResult(matched=matched,
+                            modified=ret.get('nModified', matched) or 0,
+                            upserted_id=upserted_id)
+
+    def distinct(self, fieldname):
+        """ Get the distinct values of a field in the results
+        """
+        key = self.cls.get_field_key(fieldname)
+        return self.get_cursor().distinct(key)
+
+    def sum(self, fieldname):
+        """ Get the sum of a field over the results
+        """
+        for datadict in self.group_by(total=('sum', fieldname)):
+            return datadict['total']
+        return 0
+
+def iter_chunks(iterable, size):
+    """ Split an iterable into lists of at most size items
+    """
+    chunk = []
+    for v in iterable:
+        chunk.append(v)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class BulkResult(object):
+    """ Counters and per batch errors of a bulk write
+    errors is a list of (batch index, BulkWriteError)
+    """
+    def __init__(self):
+        self.batches = 0
+        self.inserted = 0
+        self.updated = 0
+        self.upserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def __repr__(self):
+        return ('<BulkResult batches=%d inserted=%d updated=%d '
+                'upserted=%d failed=%d>' % (
+                self.batches, self.inserted, self.updated,
+                self.upserted, self.failed))
+
+class UpdateResult(object):
+    """ Counters of a multi-document update
+    """
+    def __init__(self, matched=0, modified=0, upserted_id=None):
+        self.matched = matched
+        self.modified = modified
+        self.upserted_id = upserted_id
+
+    def __repr__(self):
+        return ('<UpdateResult matched=%d modified=%d upserted_id=%r>' % (
+                self.matched, self.modified, self.upserted_id))
+
+# Formats of export and import, bson is the format of mongodump
+export_formats = ('bson', 'jsonl')
+
+def encode_document(doc, format):
+    if format == 'bson':
+        raw = getattr(doc, 'raw', None)
+        if raw is not None:
+            return raw
+        return BSON.encode(doc)
+    return json_util.dumps(doc) + '\n'
+
+def read_export_stream(stream, format):
+    """ Read the documents of an export stream one by one
+    """
+    if format == 'bson':
+        while True:
+            head = stream.read(4)
+            if not head:
+                return
+            size = struct.unpack('<i', head.ljust(4, '\0'))[0]
+            data = head + stream.read(size - 4)
+            if len(head) < 4 or len(data) < size:
+                raise ValueError('truncated bson document')
+            yield BSON(data).decode()
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json_util.loads(line)
+
+if RawBSONDocument is not None:
+    raw_codec_options = CodecOptions(document_class=RawBSONDocument,
+                                     tz_aware=True)
+    _element_codec_options = CodecOptions(tz_aware=True)
+    def decode_bson(data):
+        return BSON(data).decode(codec_options=_element_codec_options)
+else:
+    raw_codec_options = None
+    def decode_bson(data):
+        return BSON(data).decode(tz_aware=True)
+
+# Sizes of the values of bson element types, None for the types
+# prefixed by an int32 size
+_fixed_bson_sizes = {'\x01': 8, '\x06': 0, '\x07': 12, '\x08': 1,
+                     '\x09': 8, '\x0a': 0, '\x10': 4, '\x11': 8,
+                     '\x12': 8, '\x13': 16, '\xff': 0, '\x7f': 0}
+
+def bson_value_size(etype, raw, pos):
+    """ Get the size of the value of an element at pos
+    """
+    size = _fixed_bson_sizes.get(etype)
+    if size is not None:
+        return size
+    if etype in '\x02\x0d\x0e':
+        # String, code and symbol: int32 length + bytes
+        return 4 + struct.unpack_from('<i', raw, pos)[0]
+    elif etype in '\x03\x04\x0f':
+        # Document, array and code with scope include their size
+        return struct.unpack_from('<i', raw, pos)[0]
+    elif etype == '\x05':
+        # Binary: int32 length + subtype + bytes
+        return 5 + struct.unpack_from('<i', raw, pos)[0]
+    elif etype == '\x0b':
+        # Regex: two cstrings
+        end = raw.index('\x00', raw.index('\x00', pos) + 1)
+        return end + 1 - pos
+    elif etype == '\x0c':
+        # DBPointer: string + ObjectId
+        return 4 + struct.unpack_from('<i', raw, pos)[0] + 12
+    raise ValueError('unknown bson type %r' % etype)
+
+class LazyDocument(object):
+    """ The raw bson of a document whose values are decoded one by
+    one on first access, see Model.lazy_bson
+    """
+    __slots__ = ('raw', 'offsets')
+    def __init__(self, raw):
+        self.raw = raw
+        self.offsets = None
+
+    def scan(self):
+        """ Find the offsets of the elements without decoding them
+        """
+        raw = self.raw
+        offsets = {}
+        pos = 4
+        end = len(raw) - 1
+        while pos < end:
+            start = pos
+            name_end = raw.index('\x00', pos + 1)
+            name = raw[pos + 1:name_end]
+            pos = name_end + 1
+            pos += bson_value_size(raw[start], raw, pos)
+            offsets[name] = (start, pos)
+        self.offsets = offsets
+
+    def get(self, key, default=None):
+        """ Decode the value of key
+        """
+        if self.offsets is None:
+            self.scan()
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        span = self.offsets.get(key)
+        if span is None:
+            return default
+        start, stop = span
+        element = self.raw[start:stop]
+        data = struct.pack('<i', len(element) + 5) + element + '\x00'
+        return decode_bson(data).values()[0]
+
+    def discard(self, key):
+        """ Forget the value of key, once it is kept elsewhere
+        """
+        if self.offsets is None:
+            self.scan()
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        self.offsets.pop(key, None)
+
+    def pop(self, key, default=None):
+        """ Decode the value of key, it is not kept in the document
+        afterwards
+        """
+        value = self.get(key, default)
+        self.discard(key)
+        return value
+
+# Typecodes of array.array when numpy is missing, datetimes are
+# stored as milliseconds since epoch
+try:
+    array.array('q')
+    _int64_code = 'q'
+except ValueError:
+    # Python 2 has no 'q', long is 64 bits on LP64 platforms
+    _int64_code = 'l'
+_array_codes = {'int64': _int64_code, 'float64': 'd', 'bool': 'b',
+                'datetime64[ms]': _int64_code}
+
+# Missing datetimes, NaT of numpy
+_nat = -2 ** 63
+
+def datetime_to_ms(value):
+    if value is None:
+        return _nat
+    return (calendar.timegm(value.utctimetuple()) * 1000 +
+            value.microsecond // 1000)
+
+def make_column(column_type, values):
+    """ Make a numpy array, or an array.array if numpy is missing, or
+    a list for objects
+    """
+    if column_type is None:
+        if numpy is not None:
+            column = numpy.empty(len(values), dtype=object)
+            column[:] = values
+            return column
+        return values
+    if column_type == 'datetime64[ms]':
+        values = [datetime_to_ms(v) for v in values]
+        if numpy is not None:
+            return numpy.array(values, dtype='int64').view(column_type)
+    elif numpy is not None:
+        return numpy.array(values, dtype=column_type)
+    return array.array(_array_codes[column_type], values)
+
+def concat_columns(columns):
+    if not columns:
+        return None
+    if numpy is not None:
+        return numpy.concatenate(columns)
+    result = columns[0]
+    for column in columns[1:]:
+        result.extend(column)
+    return result
+
+def is_gzip_stream(stream):
+    """ Peek the magic number of gzip if the stream is seekable
+    """
+    try:
+        pos = stream.tell()
+        head = stream.read(2)
+        stream.seek(pos)
+    except (AttributeError, IOError):
+        return False
+    return head == '\x1f\x8b'
+
+def bulk_write_documents(col, docs, result, upsert=False):
+    """ Insert documents, or replace them by _id if upsert is True,
+    in one unordered bulk operation counted in result
+    """
+    bulk = col.initialize_unordered_bulk_op()
+    for doc in docs:
+        if upsert and '_id' in doc:
+            bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+        else:
+            bulk.insert(doc)
+    try:
+        ret = bulk.execute()
+    except BulkWriteError, e:
+        ret = e.details
+        result.errors.append((result.batches, e))
+        result.failed += len(ret['writeErrors'])
+    result.inserted += ret.get('nInserted', 0)
+    result.updated += (ret.get('nModified', 0) or 0)
+    result.upserted += ret.get('nUpserted', 0)
+    result.batches += 1
+
+class FileExporter(object):
+    """ Write the GridFS files and chunks documents referenced by
+    FileFields to a stream, as {'c': 'files' or 'chunks', 'd': doc}
+    """
+    def __init__(self, cls, stream, format='bson', compress=False):
+        database = getattr(cls, '__database__', default_db)
+        self.db = get_database(database)
+        if compress:
+            stream = gzip.GzipFile(fileobj=stream, mode='wb')
+        self.stream = stream
+        self.compress = compress
+        self.format = format
+        self.exported = set()
+
+    def export(self, objid):
+        if not objid or objid in self.exported:
+            return
+        self.exported.add(objid)
+        for name, spec in (('files', {'_id': objid}),
+                           ('chunks', {'files_id': objid})):
+            cursor = self.db['fs.' + name].find(spec)
+            if name == 'chunks':
+                cursor = cursor.sort('n', ASCENDING)
+            for doc in cursor:
+                self.stream.write(encode_document({'c': name, 'd': doc},
+                                                  self.format))
+
+    def close(self):
+        if self.compress:
+            self.stream.close()
+
+def import_files(cls, stream, format='bson', batch_size=100,
+                 compress=None):
+    """ Write the files exported by FileExporter to GridFS
+    """
+    database = getattr(cls, '__database__', default_db)
+    db = get_database(database)
+    if compress or (compress is None and is_gzip_stream(stream)):
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    result = BulkResult()
+    for batch in iter_chunks(read_export_stream(stream, format), batch_size):
+        for name in ('files', 'chunks'):
+            docs = [rec['d'] for rec in batch if rec['c'] == name]
+            if docs:
+                bulk_write_documents(db['fs.' + name], docs, result,
+                                     upsert=True)
+    return result
+
+def _mark_dirty(obj, key):
+    try:
+        obj._dirty_keys.add(key)
+    except AttributeError:
+        obj._dirty_keys = set([key])
+
+def _mark_loaded(obj, fieldname):
+    # An assigned field is no longer deferred, it is written as is
+    deferred = getattr(obj, '_deferred', None)
+    if deferred:
+        deferred.discard(fieldname)
+
+def _tracked(method):
+    def tracked_method(self, *args, **kwargs):
+        _mark_dirty(self.owner, self.key)
+        return method(self, *args, **kwargs)
+    tracked_method.__name__ = method.__name__
+    return tracked_method
+
+class TrackedList(list):
+    """ A list that marks the key of its owner object dirty when
+    it is changed
+    """
+    def __init__(self, value, owner, key):
+        super(TrackedList, self).__init__(value)
+        self.owner = owner
+        self.key = key
+
+    __setitem__ = _tracked(list.__setitem__)
+    __delitem__ = _tracked(list.__delitem__)
+    __setslice__ = _tracked(list.__setslice__)
+    __delslice__ = _tracked(list.__delslice__)
+    __iadd__ = _tracked(list.__iadd__)
+    __imul__ = _tracked(list.__imul__)
+    append = _tracked(list.append)
+    extend = _tracked(list.extend)
+    insert = _tracked(list.insert)
+    pop = _tracked(list.pop)
+    remove = _tracked(list.remove)
+    reverse = _tracked(list.reverse)
+    sort = _tracked(list.sort)
+
+    def __reduce__(self):
+        # Pickled as a plain list, tracked again on access
+        return (list, (list(self),))
+
+class TrackedDict(dict):
+    """ A dict that marks the key of its owner object dirty when
+    it is changed
+    """
+    def __init__(self, value, owner, key):
+        super(TrackedDict, self).__init__(value)
+        self.owner = owner
+        self.key = key
+
+    __setitem__ = _tracked(dict.__setitem__)
+    __delitem__ = _tracked(dict.__delitem__)
+    clear = _tracked(dict.clear)
+    pop = _tracked(dict.pop)
+    popitem = _tracked(dict.popitem)
+    setdefault = _tracked(dict.setdefault)
+    update = _tracked(dict.update)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
 
 class Field(object):
     """ Field that defines the schema of a DB
     Much like the field of relation db ORMs
     A proxy of a object's attribute
     """
+    # Type of the column of to_columns, None for objects
+    column_type = None
+
     def __init__(self, default=None, **args):
         self._fieldname = None
         self.default_value = default
@@ -225,13 +2136,51 @@ class Field(object):
         return self.__get__(obj)
 
     def __get__(self, obj, type=None):
-        v =  getattr(obj, self.get_obj_key(),
-                     self.default_value)
+        v =  getattr(obj, self.get_obj_key(), _missing)
+        if v is _missing:
+            lazy = getattr(obj, '_lazy', None)
+            if lazy is not None:
+                # Shared objects may be read by other threads, the
+                # value is stored before it is discarded from lazy
+                v = lazy.get(self.get_key(), _missing)
+                if v is not _missing:
+                    setattr(obj, self.get_obj_key(), v)
+                    lazy.discard(self.get_key())
+                    return v
+                # Decoded by another thread meanwhile
+                v = getattr(obj, self.get_obj_key(), _missing)
+                if v is not _missing:
+                    return v
+            deferred = getattr(obj, '_deferred', None)
+            if deferred and self.fieldname in deferred:
+                obj.load_deferred(self.fieldname)
+                # Not self.__get__, subclasses may wrap the raw value
+                return getattr(obj, self.get_obj_key(), self.default_value)
+            return self.default_value
         return v
 
     def __set__(self, obj, value):
         if value is not None:
             setattr(obj, self.get_obj_key(), value)
+            _mark_dirty(obj, self.get_key())
+            _mark_loaded(obj, self.fieldname)
+
+    def coerce(self, value):
+        """ Convert a value by the type rules of the field, for the
+        values of updates that bypass __set__
+        """
+        return value
+
+    def __delete__(self, obj):
+        try:
+            delattr(obj, self.get_obj_key())
+        except AttributeError:
+            pass
+        lazy = getattr(obj, '_lazy', None)
+        if lazy is not None:
+            lazy.discard(self.get_key())
+        _mark_dirty(obj, self.get_key())
+        _mark_loaded(obj, self.fieldname)
 
     def __del__(self):
         pass
@@ -243,59 +2192,90 @@ class Field(object):
         return '_' + self.fieldname
 
 class BooleanField(Field):
+    column_type = 'bool'
+
     def __init__(self, default=False, **kwargs):
         super(BooleanField, self).__init__(default=default,
                                            **kwargs)
 
     def __set__(self, obj, value):
-        value = not not value
-        super(BooleanField, self).__set__(obj, value)
+        super(BooleanField, self).__set__(obj, self.coerce(value))
+
+    def coerce(self, value):
+        return not not value
 
 class IntegerField(Field):
+    column_type = 'int64'
+
     def __init__(self, default=0, **kwargs):
         super(IntegerField, self).__init__(default=default,
                                            **kwargs)
 
     def __set__(self, obj, value):
-        value = long(value)
-        super(IntegerField, self).__set__(obj, value)
+        super(IntegerField, self).__set__(obj, self.coerce(value))
+
+    def coerce(self, value):
+        return long(value)
 
 class FloatField(Field):
+    column_type = 'float64'
+
     def __init__(self, default=0, **kwargs):
         super(FloatField, self).__init__(default=default,
                                            **kwargs)
 
     def __set__(self, obj, value):
-        value = float(value)
-        super(FloatField, self).__set__(obj, value)
+        super(FloatField, self).__set__(obj, self.coerce(value))
+
+    def coerce(self, value):
+        return float(value)
 
 class SequenceField(IntegerField):
-    def __init__(self, key, default=0, **kwargs):
+    """ An auto increasing integer field, values are taken from
+    blocks of block_size reserved on the sequence of key
+    """
+    def __init__(self, key, default=0, block_size=None, **kwargs):
         self.key = key
+        self.block_size = block_size
         super(SequenceField, self).__init__(default=default, **kwargs)
 
 class StringField(Field):
     def __set__(self, obj, value):
+        super(StringField, self).__set__(obj, self.coerce(value))
+
+    def coerce(self, value):
         if isinstance(value, unicode):
-            pass
+            return value
         elif isinstance(value, basestring):
-            value = unicode(value, 'utf-8')
+            return unicode(value, 'utf-8')
         else:
-            value = unicode(value)
-        super(StringField, self).__set__(obj, value)
+            return unicode(value)
 
 class CollectionField(Field):
+    tracked_class = None
+
     def __get__(self, obj, type=None):
         val = super(CollectionField, self).__get__(obj, type=type)
         if val is None:
             val = self.get_default_value()
-            self.__set__(obj, val)
+        if not isinstance(val, self.tracked_class) or val.owner is not obj:
+            # Track in-place changes, the default value only
+            # becomes dirty when it is changed
+            val = self.tracked_class(val, obj, self.get_key())
+            setattr(obj, self.get_obj_key(), val)
         return val
 
     def get_default_value(self):
         raise NotImplemented
 
+    def coerce_item(self, value):
+        """ Convert an item pushed to the collection
+        """
+        return value
+
 class ArrayField(CollectionField):
+    tracked_class = TrackedList
+
     def get_default_value(self):
         return []
 
@@ -307,9 +2287,23 @@ class ChildrenField(ArrayField):
     def get_child_class(self, obj):
         return self.child_cls
 
+    def get_raw(self, obj):
+        return super(ChildrenField, self).__get__(obj)
+
+    def get_cache_key(self):
+        return children_cache_key(self.fieldname)
+
     def __get__(self, obj, type=None):
+        cache = getattr(obj, self.get_cache_key(), None)
+        if cache is not None:
+            return cache.children
         arr = super(ChildrenField, self).__get__(obj, type=type)
-        objarr = [self.child_cls(**v) for v in arr]
+        objarr = [self.child_cls.get_from_data(v) for v in arr]
+        prefetched = getattr(obj, '_prefetched', None)
+        if prefetched is not None:
+            for child in objarr:
+                child._prefetched = prefetched
+        setattr(obj, self.get_cache_key(), ChildrenCache(objarr))
         return objarr
 
     def __set__(self, obj, arr):
@@ -319,8 +2313,68 @@ class ChildrenField(ArrayField):
                 v = v.get_dict()
             value.append(v)
         super(ChildrenField, self).__set__(obj, value)
+        if getattr(obj, self.get_cache_key(), None) is not None:
+            setattr(obj, self.get_cache_key(), None)
+
+    def coerce(self, value):
+        return [self.coerce_item(v) for v in value]
+
+    def coerce_item(self, value):
+        if isinstance(value, Model):
+            return value.get_dict()
+        return value
+
+    def sync(self, obj):
+        """ Write the changes of the materialized children back to
+        the raw array. Changed children are marked as positional
+        dirty keys, appended ones are recorded as pushes.
+        """
+        cache = getattr(obj, self.get_cache_key(), None)
+        if cache is None:
+            return
+        raw = self.get_raw(obj)
+        children = cache.children
+        key = self.get_key()
+        if (len(children) < len(raw) or
+            len(cache.originals) != len(raw)):
+            # Removed children or the raw array was changed
+            # directly, rewrite the whole array
+            raw[:] = [child.get_dict() for child in children]
+            cache.originals = list(children)
+            return
+        for i, child in enumerate(children[:len(raw)]):
+            if (child is cache.originals[i] and
+                not getattr(child, '_dirty_keys', None)):
+                continue
+            doc = child.get_dict()
+            if doc != raw[i]:
+                list.__setitem__(raw, i, doc)
+                _mark_dirty(obj, '%s.%d' % (key, i))
+        if len(children) > len(raw):
+            docs = [child.get_dict() for child in children[len(raw):]]
+            list.extend(raw, docs)
+            pushes = getattr(obj, '_pushes', None)
+            if pushes is None:
+                pushes = obj._pushes = {}
+            pushes.setdefault(key, []).extend(docs)
+        cache.originals = list(children)
+
+def children_cache_key(fieldname):
+    return '_%s_children' % fieldname
+
+class ChildrenCache(object):
+    """ The materialized children of an object, and the children
+    at the time of last sync with the raw array
+    """
+    __slots__ = ('children', 'originals')
+
+    def __init__(self, children):
+        self.children = children
+        self.originals = list(children)
 
 class DictField(CollectionField):
+    tracked_class = TrackedDict
+
     def get_default_value(self):
         return {}
 
@@ -329,112 +2383,769 @@ class ObjectIdField(Field):
     def toObjectId(cls, v):
         if v is None:
             return None
-        elif isinstance(v, basestring):
-            # TODO: handle invalidid exception
-            return ObjectId(v)
-        else:
-            assert isinstance(v, ObjectId)
-            return v
+        elif isinstance(v, basestring):
+            # TODO: handle invalidid exception
+            return ObjectId(v)
+        else:
+            assert isinstance(v, ObjectId)
+            return v
+
+    def __init__(self, default=None, **kwargs):
+        super(ObjectIdField, self).__init__(default=default,
+                                           **kwargs)
+
+    def __set__(self, obj, value):
+        value = self.toObjectId(value)
+        super(ObjectIdField, self).__set__(obj, value)
+
+    def coerce(self, value):
+        if isinstance(value, Model):
+            value = value.id
+        return self.toObjectId(value)
+
+    def get_key(self):
+        return '_' + self.fieldname
+
+def file_handle_key(fieldname):
+    return '_%s_file' % fieldname
+
+class FileField(ObjectIdField):
+    """ A file stored in GridFS. A string, a file-like object or an
+    iterator of chunks is uploaded in chunk_size pieces on assignment,
+    the replaced file is deleted after the object is saved.
+    """
+    def __init__(self, default=None, chunk_size=None, **kwargs):
+        super(FileField, self).__init__(default=default, **kwargs)
+        self.chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+
+    def get_obj_key(self):
+        return '_' + self.fieldname
+
+    @staticmethod
+    def get_fs(obj):
+        cls = obj.__class__
+        database = getattr(cls, '__database__', default_db)
+        check_fork()
+        fs = _fs_pool.get(database)
+        if fs is None:
+            fs = GridFS(get_database(database))
+            _fs_pool[database] = fs
+        if instrumentation is not None:
+            return InstrumentedGridFS(fs, cls, instrumentation)
+        return fs
+
+    def get_handle_key(self):
+        return file_handle_key(self.fieldname)
+
+    def __get__(self, obj, type=None):
+        objid = super(FileField, self).__get__(obj, type=type)
+        if not objid:
+            return None
+        # Objects are shared by threads through the object cache,
+        # every thread reads with its own file position
+        handles = getattr(obj, self.get_handle_key(), None)
+        f = getattr(handles, 'file', None)
+        if f is not None and f._id == objid:
+            f.seek(0)
+            return f
+        f = self.get_fs(obj).get(objid)
+        if handles is None:
+            handles = threading.local()
+            setattr(obj, self.get_handle_key(), handles)
+        handles.file = f
+        return f
+
+    def get_raw(self, obj):
+        return super(FileField, self).__get__(obj)
+
+    def __set__(self, obj, value):
+        if value is None:
+            return
+        if isinstance(value, ObjectId):
+            objid = value
+        elif hasattr(value, '_id'):
+            # GridIn or GridOut
+            objid = value._id
+        else:
+            objid = self.upload(obj, value)._id
+        old_objid = self.get_raw(obj)
+        if old_objid and old_objid != objid:
+            deletes = getattr(obj, '_file_deletes', None)
+            if deletes is None:
+                deletes = obj._file_deletes = []
+            deletes.append(old_objid)
+        super(FileField, self).__set__(obj, objid)
+        if getattr(obj, self.get_handle_key(), None) is not None:
+            setattr(obj, self.get_handle_key(), None)
+
+    def upload(self, obj, value, **kwargs):
+        """ Upload a string, a file-like object or an iterator of
+        chunks, in constant memory except for strings
+        """
+        fs = self.get_fs(obj)
+        kwargs.setdefault('chunkSize', self.chunk_size)
+        start = time.time()
+        f = fs.new_file(**kwargs)
+        try:
+            if isinstance(value, basestring):
+                f.write(value)
+            elif hasattr(value, 'read'):
+                while True:
+                    data = value.read(self.chunk_size)
+                    if not data:
+                        break
+                    f.write(data)
+            else:
+                for data in value:
+                    f.write(data)
+            f.close()
+        except:
+            f.close()
+            fs.delete(f._id)
+            raise
+        if instrumentation is not None:
+            instrumentation.record(obj.__class__, 'gridfs_upload',
+                                   time.time() - start, 1, f.length)
+        return f
+
+    def iter_range(self, obj, start=0, end=None, block_size=None):
+        """ Iterate over the bytes from start to end (exclusive) of
+        the file, for serving partial content
+        """
+        objid = self.get_raw(obj)
+        if not objid:
+            return
+        # A handle of its own, the ranges of a file may be served
+        # concurrently
+        f = self.get_fs(obj).get(objid)
+        if end is None or end > f.length:
+            end = f.length
+        block_size = block_size or self.chunk_size
+        f.seek(start)
+        remaining = end - start
+        elapsed = 0.0
+        while remaining > 0:
+            t = time.time()
+            data = f.read(min(block_size, remaining))
+            elapsed += time.time() - t
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+        if instrumentation is not None:
+            instrumentation.record(obj.__class__, 'gridfs_read', elapsed,
+                                   1, end - start - remaining)
+
+class ReferenceField(ObjectIdField):
+    def __init__(self, ref_cls, default=None, **kwargs):
+        super(ReferenceField, self).__init__(default=default,
+                                           **kwargs)
+        self.ref_cls = ref_cls
+
+    def get_raw(self, obj):
+        return super(ReferenceField, self).__get__(obj)
+
+    def get_ref_class(self, obj):
+        return self.ref_cls == 'self' and obj.__class__ or self.ref_cls
+
+    def __get__(self, obj, type=None):
+        objid = super(ReferenceField, self).__get__(obj, type=type)
+        if objid is self.default_value:
+            return self.default_value
+        prefetched = getattr(obj, '_prefetched', None)
+        if prefetched is not None and objid in prefetched:
+            return prefetched[objid]
+        ref_cls = self.get_ref_class(obj)
+        val = ref_cls.get(objid)
+        return val
+
+    def __set__(self, obj, value):
+        ref_cls = self.get_ref_class(obj)
+        if isinstance(value, ref_cls):
+            value = ObjectId(value.id)
+        super(ReferenceField, self).__set__(obj, value)
+
+class DateTimeField(Field):
+    column_type = 'datetime64[ms]'
+
+    def __init__(self, default=None, **kwargs):
+        self.auto_now_add = kwargs.get('auto_now_add', False)
+        self.auto_now = kwargs.get('auto_now', False)
+        super(DateTimeField, self).__init__(default=default,
+                                            **kwargs)
+
+    def __get__(self, obj, type=None):
+        val = super(DateTimeField, self).__get__(obj,
+                                                 type=type)
+        if val is None:
+            if self.auto_now and self.auto_now_add:
+                val = utc_now()
+                self.__set__(obj, val)
+        return val
+
+    def __set__(self, obj, value):
+        super(DateTimeField, self).__set__(obj, self.coerce(value))
+
+    def coerce(self, value):
+        if value is not None:
+            assert isinstance(value, datetime)
+        return value
+
+def get_attributes(obj):
+    """ Get the attributes of an object stored both in __slots__ and
+    in __dict__, the __dict__ of objects using slots is left alone as
+    reading it would allocate one
+    """
+    attrs = {}
+    for klass in type(obj).__mro__:
+        for name in vars(klass).get('__slots__', ()):
+            try:
+                attrs[name] = getattr(obj, name)
+            except AttributeError:
+                pass
+    if not getattr(obj, 'use_slots', False):
+        attrs.update(vars(obj))
+    return attrs
+
+def estimate_size(value):
+    """ Roughly estimate the memory taken by a value in bytes
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, Model):
+        value = get_attributes(value)
+    if isinstance(value, dict):
+        for k, v in value.iteritems():
+            size += estimate_size(k) + estimate_size(v)
+    elif isinstance(value, (list, tuple, set)):
+        for v in value:
+            size += estimate_size(v)
+    return size
+
+class ObjectCache(object):
+    """ A bounded cache of model objects keyed by their _id
+
+    max_size limits the number of cached objects, max_bytes limits
+    the estimated memory of them and ttl expires objects older than
+    the given seconds. Subclasses choose the object to evict once a
+    limit is reached.
+    """
+    def __init__(self, max_size=None, max_bytes=None, ttl=None,
+                 sizeof=estimate_size):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.lock = threading.RLock()
+        self.clear()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def stats(self):
+        return {'size': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+    def clear(self):
+        with self.lock:
+            # key -> (obj, expire_at, nbytes)
+            self.entries = {}
+            self.total_bytes = 0
+            self.clear_policy()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[1] is not None and entry[1] < time.time():
+                self.remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.touch(key)
+            return entry[0]
+
+    def set(self, key, obj, nbytes=None, ttl=None):
+        """ Cache obj under key, ttl overrides the ttl of the cache
+        """
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            if self.max_bytes is not None and nbytes is None:
+                nbytes = self.sizeof(obj)
+            nbytes = nbytes or 0
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                return
+            while self.entries and self.is_full(nbytes):
+                self.remove(self.victim())
+                self.evictions += 1
+            if ttl is None:
+                ttl = self.ttl
+            if ttl is not None:
+                expire_at = time.time() + ttl
+            else:
+                expire_at = None
+            self.entries[key] = (obj, expire_at, nbytes)
+            self.total_bytes += nbytes
+            self.add(key)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            return self.remove(key)
+
+    def remove(self, key):
+        obj, expire_at, nbytes = self.entries.pop(key)
+        self.total_bytes -= nbytes
+        self.discard(key)
+        return obj
+
+    def purge_expired(self):
+        """ Drop all expired objects, return the number dropped
+        """
+        now = time.time()
+        with self.lock:
+            expired = [key for key, entry in self.entries.iteritems()
+                       if entry[1] is not None and entry[1] < now]
+            for key in expired:
+                self.remove(key)
+            self.expirations += len(expired)
+        return len(expired)
+
+    def is_full(self, nbytes=0):
+        """ Whether there is no room for one more object of nbytes
+        """
+        if (self.max_size is not None and
+            len(self.entries) >= self.max_size):
+            return True
+        if (self.max_bytes is not None and
+            self.total_bytes + nbytes > self.max_bytes):
+            return True
+        return False
+
+    def __getitem__(self, key):
+        obj = self.get(key, _missing)
+        if obj is _missing:
+            raise KeyError(key)
+        return obj
+
+    def __setitem__(self, key, obj):
+        self.set(key, obj)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        with self.lock:
+            return self.entries.keys()
+
+    # Eviction policy, override these in subclasses
+    def clear_policy(self):
+        pass
+
+    def add(self, key):
+        pass
+
+    def touch(self, key):
+        pass
+
+    def discard(self, key):
+        pass
+
+    def victim(self):
+        return next(iter(self.entries))
+
+class LRUCache(ObjectCache):
+    """ Evict the least recently used object first
+    """
+    def clear_policy(self):
+        self.order = OrderedDict()
+
+    def add(self, key):
+        self.order[key] = None
+
+    def touch(self, key):
+        del self.order[key]
+        self.order[key] = None
+
+    def discard(self, key):
+        del self.order[key]
+
+    def victim(self):
+        return next(iter(self.order))
+
+class LFUCache(ObjectCache):
+    """ Evict the least frequently used object first, the least
+    recently used one among objects of the same frequency
+    """
+    def clear_policy(self):
+        self.freqs = {}
+        self.buckets = defaultdict(OrderedDict)
+        self.min_freq = 0
+
+    def add(self, key):
+        self.freqs[key] = 1
+        self.buckets[1][key] = None
+        self.min_freq = 1
+
+    def touch(self, key):
+        freq = self.discard(key)
+        self.freqs[key] = freq + 1
+        self.buckets[freq + 1][key] = None
+
+    def discard(self, key):
+        freq = self.freqs.pop(key)
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[freq]
+        return freq
+
+    def victim(self):
+        if self.min_freq not in self.buckets:
+            self.min_freq = min(self.buckets)
+        return next(iter(self.buckets[self.min_freq]))
+
+cache_policies = {
+    'lru': LRUCache,
+    'lfu': LFUCache,
+    }
+
+def make_obj_cache(policy='lru', **options):
+    """ Make an object cache by policy name or ObjectCache subclass
+    """
+    if isinstance(policy, basestring):
+        policy = cache_policies[policy]
+    return policy(**options)
+
+# Counts of CursorWrapper cached across wrappers, see
+# Model.count_cache_ttl
+count_cache = LRUCache(max_size=10000)
+
+cache_classes = set()
+def clear_obj_cache():
+    for cls in cache_classes:
+        if cls.use_obj_cache:
+            cls.obj_cache.clear()
+
+def obj_cache_stats():
+    """ Get the cache stats of all model classes
+    """
+    return dict((cls.__name__, cls.obj_cache.stats())
+                for cls in cache_classes
+                if cls.use_obj_cache)
+
+class InvalidationBus(object):
+    """ Broadcast the evictions of object caches to other processes
+    through a capped collection, every process tails the collection
+    and evicts its own caches, see set_invalidation_bus
+    """
+    def __init__(self, database=None, col_name='mongopie_invalidation',
+                 size=1024 * 1024, max_messages=10000, tailable=True,
+                 poll_interval=0.5):
+        self.database = database
+        self.col_name = col_name
+        self.size = size
+        self.max_messages = max_messages
+        self.tailable = tailable
+        self.poll_interval = poll_interval
+        self.published = 0
+        self.received = 0
+        self.applied = 0
+        self.last_id = None
+        # Messages applied in the overlap of reopened cursors
+        self.seen = OrderedDict()
+        self.thread = None
+        self.stopped = threading.Event()
+        self.reset()
+
+    def reset(self):
+        # Tell the messages of this process from the others', forked
+        # processes get their own source
+        self.pid = os.getpid()
+        self.source = str(ObjectId())
+        self.cursor = None
+        self.col = None
+
+    def collection(self):
+        if self.col is None:
+            db = get_database(self.database or default_db)
+            if self.col_name not in db.collection_names():
+                try:
+                    db.create_collection(self.col_name, capped=True,
+                                         size=self.size,
+                                         max=self.max_messages)
+                except CollectionInvalid:
+                    # Created by another process
+                    pass
+            self.col = db[self.col_name]
+        return self.col
+
+    def publish(self, cls, objids=None):
+        """ Tell other processes to evict objids of cls, or all
+        objects of cls if objids is None
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        if objids is not None:
+            objids = list(objids)
+            if not objids:
+                return
+        self.collection().insert({'src': self.source,
+                                  'cls': cls.__name__,
+                                  'ids': objids,
+                                  'ts': utc_now()})
+        self.published += 1
+
+    def open_cursor(self):
+        col = self.collection()
+        if self.last_id is None:
+            # Start from the newest message, the caches of a new
+            # subscriber are empty anyway
+            latest = list(col.find().sort('$natural', DESCENDING).limit(1))
+            self.last_id = latest[0]['_id'] if latest else ObjectId()
+            return None
+        # ObjectIds of different processes are not strictly ordered,
+        # so start a bit earlier, evicting twice is harmless
+        since = ObjectId.from_datetime(
+            self.last_id.generation_time - timedelta(seconds=1))
+        spec = {'_id': {'$gte': since}}
+        if not self.tailable:
+            return col.find(spec)
+        if CursorType is not None:
+            return col.find(spec, cursor_type=CursorType.TAILABLE_AWAIT)
+        return col.find(spec, tailable=True, await_data=True)
 
-    def __init__(self, default=None, **kwargs):
-        super(ObjectIdField, self).__init__(default=default,
-                                           **kwargs)
+    def poll(self):
+        """ Evict the caches by the messages published since the last
+        poll, return the number of messages applied
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        if self.cursor is None or not self.cursor.alive:
+            self.cursor = self.open_cursor()
+            if self.cursor is None:
+                return 0
+        applied = 0
+        try:
+            for msg in self.cursor:
+                self.last_id = msg['_id']
+                if self.last_id in self.seen:
+                    continue
+                self.seen[self.last_id] = True
+                if len(self.seen) > self.max_messages:
+                    self.seen.popitem(last=False)
+                self.received += 1
+                if msg.get('src') == self.source:
+                    continue
+                if self.apply(msg['cls'], msg.get('ids')):
+                    applied += 1
+        finally:
+            if not self.tailable:
+                self.cursor = None
+        self.applied += applied
+        return applied
 
-    def __set__(self, obj, value):
-        value = self.toObjectId(value)
-        super(ObjectIdField, self).__set__(obj, value)
+    def apply(self, clsname, objids):
+        found = False
+        for cls in list(cache_classes):
+            if cls.__name__ == clsname:
+                cls.invalidate_cache(objids, publish=False)
+                found = True
+        return found
 
-    def get_key(self):
-        return '_' + self.fieldname
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('failed to poll the invalidation bus')
+                self.cursor = None
+            self.stopped.wait(self.poll_interval)
 
-class FileField(ObjectIdField):
-    def get_obj_key(self):
-        return '_' + self.fieldname
+    def start(self):
+        """ Poll in a daemon thread
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run,
+                                       name='mongopie-invalidation')
+        self.thread.daemon = True
+        self.thread.start()
 
-    @staticmethod
-    def get_fs(obj):
-        cls = obj.__class__
-        database = getattr(cls, '__database__', default_db)
-        server = get_server(*database)
-        return GridFS(server)
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
-    def __get__(self, obj, type=None):
-        objid = super(FileField, self).__get__(obj, type=type)
-        if not objid:
-            return None
-        fs = self.get_fs(obj)
-        f = fs.get(objid)
-        return f
+    def stats(self):
+        return {'published': self.published,
+                'received': self.received,
+                'applied': self.applied}
 
-    def get_raw(self, obj):
-        v =  getattr(obj, self.get_obj_key(),
-                     self.default_value)
-        return v
+invalidation_bus = None
+def set_invalidation_bus(bus):
+    """ Publish the cache evictions of write paths through bus, pass
+    None to evict in the local process only
+    """
+    global invalidation_bus
+    invalidation_bus = bus
 
-    def __set__(self, obj, value):
-        fs = self.get_fs(obj)
-        old_f = self.__get__(obj, type=None)
-        if old_f:
-            fs.delete(old_f._id)
-        if isinstance(value, basestring):
-            f = fs.new_file()
-            f.write(value)
-            f.close()
-            value = f
-        super(FileField, self).__set__(obj, value._id)
+class Index(object):
+    """ An index of a model declared in Model.indexes by field names,
+    a name prefixed with '-' is descending, a tuple (name, type) is
+    for special indexes like 'text' or '2dsphere', e.g.
+        indexes = [Index('user', '-created_at'),
+                   Index('email', unique=True),
+                   Index('created_at', ttl=86400),
+                   Index('tag', partial={'count': {'$gt': 0}})]
+    partial is a condition of field names.
+    """
+    def __init__(self, *fieldnames, **options):
+        self.fieldnames = fieldnames
+        self.unique = options.pop('unique', False)
+        self.sparse = options.pop('sparse', False)
+        self.ttl = options.pop('ttl', None)
+        self.partial = options.pop('partial', None)
+        self.name = options.pop('name', None)
+        # Other options of create_index
+        self.options = options
 
-class ReferenceField(ObjectIdField):
-    def __init__(self, ref_cls, default=None, **kwargs):
-        super(ReferenceField, self).__init__(default=default,
-                                           **kwargs)
-        self.ref_cls = ref_cls
+    def get_keys(self, cls):
+        keys = []
+        for name in self.fieldnames:
+            if isinstance(name, tuple):
+                name, direction = name
+            elif name.startswith('-'):
+                name, direction = name[1:], DESCENDING
+            else:
+                direction = ASCENDING
+            keys.append((cls.get_field_key(name), direction))
+        return keys
 
-    def get_raw(self, obj):
-        return super(ReferenceField, self).__get__(obj)
+    def get_name(self, cls):
+        if self.name:
+            return self.name
+        return '_'.join('%s_%s' % key for key in self.get_keys(cls))
 
-    def get_ref_class(self, obj):
-        return self.ref_cls == 'self' and obj.__class__ or self.ref_cls
+    def get_options(self, cls):
+        options = dict(self.options)
+        options['name'] = self.get_name(cls)
+        if self.unique:
+            options['unique'] = True
+        if self.sparse:
+            options['sparse'] = True
+        if self.ttl is not None:
+            options['expireAfterSeconds'] = self.ttl
+        if self.partial is not None:
+            options['partialFilterExpression'] = cls.filter_condition(
+                self.partial)
+        return options
 
-    def __get__(self, obj, type=None):
-        objid = super(ReferenceField, self).__get__(obj, type=type)
-        if objid is self.default_value:
-            return self.default_value
-        ref_cls = self.get_ref_class(obj)
-        val = ref_cls.get(objid)
-        return val
+    def matches(self, cls, info):
+        """ Whether an entry of index_information is this index
+        """
+        if [tuple(k) for k in info.get('key', ())] != [
+            tuple(k) for k in self.get_keys(cls)]:
+            return False
+        options = self.get_options(cls)
+        for k in ('unique', 'sparse'):
+            # False flags may be left out
+            if bool(info.get(k)) != bool(options.get(k)):
+                return False
+        for k in ('expireAfterSeconds', 'partialFilterExpression'):
+            if (k in info) != (k in options):
+                return False
+            if freeze(info.get(k)) != freeze(options.get(k)):
+                return False
+        return True
 
-    def __set__(self, obj, value):
-        ref_cls = self.get_ref_class(obj)
-        if isinstance(value, ref_cls):
-            value = ObjectId(value.id)
-        super(ReferenceField, self).__set__(obj, value)
+def sync_all_indexes(drop=False):
+    """ Sync the indexes of the model classes declaring indexes, see
+    Model.sync_indexes
+    """
+    return dict((cls.__name__, cls.sync_indexes(drop=drop))
+                for cls in list(cache_classes)
+                if cls.indexes)
 
-class DateTimeField(Field):
-    def __init__(self, default=None, **kwargs):
-        self.auto_now_add = kwargs.get('auto_now_add', False)
-        self.auto_now = kwargs.get('auto_now', False)
-        super(DateTimeField, self).__init__(default=default,
-                                            **kwargs)
+class UnindexedQueryError(Exception):
+    pass
 
-    def __get__(self, obj, type=None):
-        val = super(DateTimeField, self).__get__(obj,
-                                                 type=type)
-        if val is None:
-            if self.auto_now and self.auto_now_add:
-                val = utc_now()
-                self.__set__(obj, val)
-        return val
+# Explain queries and warn or raise on collection scans and in memory
+# sorts, see check_queries
+query_check_mode = None
+_checked_queries = set()
 
-    def __set__(self, obj, value):
-        if value is not None:
-            assert isinstance(value, datetime)
-        super(DateTimeField, self).__set__(obj, value)
+def check_queries(mode='warn'):
+    """ Check the plans of new query shapes in development, mode is
+    'warn', 'raise' or None to stop checking
+    """
+    global query_check_mode
+    assert mode in ('warn', 'raise', None)
+    query_check_mode = mode
+    _checked_queries.clear()
 
-cache_classes = set()
-def clear_obj_cache():
-    for cls in cache_classes:
-        if cls.use_obj_cache:
-            cls.obj_cache = {}
+def get_plan_stages(plan):
+    """ Get the stage names of an explain output, the old style
+    output of mongodb 2.x is mapped to COLLSCAN and SORT
+    """
+    stages = set()
+    if 'queryPlanner' in plan:
+        todo = [plan['queryPlanner'].get('winningPlan', {})]
+        while todo:
+            stage = todo.pop()
+            stages.add(stage.get('stage'))
+            if 'inputStage' in stage:
+                todo.append(stage['inputStage'])
+            todo.extend(stage.get('inputStages', ()))
+    else:
+        if plan.get('cursor', '').startswith('BasicCursor'):
+            stages.add('COLLSCAN')
+        if plan.get('scanAndOrder'):
+            stages.add('SORT')
+    return stages
+
+def check_query(cls, cursor, conditions, orders):
+    """ Explain a query of a new shape and report collection scans
+    and in memory sorts by query_check_mode
+    """
+    if not (conditions or orders):
+        # Listing all documents is a scan anyway
+        return
+    key = (cls, freeze(normalize_query(conditions)), freeze(orders))
+    if key in _checked_queries:
+        return
+    _checked_queries.add(key)
+    stages = get_plan_stages(cursor.explain())
+    problems = [name for name in ('COLLSCAN', 'SORT') if name in stages]
+    if not problems:
+        return
+    msg = '%s query %r sort %r uses %s at %s' % (
+        cls.__name__, normalize_query(conditions), orders,
+        ' and '.join(problems), find_caller())
+    if query_check_mode == 'raise':
+        raise UnindexedQueryError(msg)
+    logger.warning(msg)
 
 class ModelMeta(type):
     """ The meta class of Model
@@ -450,12 +3161,37 @@ class ModelMeta(type):
                     meta.__clsdicts__.get(baseclsname, {}))
         allclassdict.update(classdict)
         meta.__clsdicts__[clsname] = allclassdict
+        if allclassdict.get('use_slots'):
+            allclassdict = dict(allclassdict)
+            allclassdict['__slots__'] = meta.get_slots(bases, allclassdict)
         cls = type.__new__(meta, clsname, bases, allclassdict)
         if clsname == 'Model':
             return cls
         cls.initialize()
         return cls
 
+    @staticmethod
+    def get_slots(bases, classdict):
+        """ Get the slots to store the fields and internal states
+        of objects
+        """
+        names = set(model_internal_attrs)
+        names.add('_id')
+        for name, v in classdict.iteritems():
+            if isinstance(v, Field):
+                names.add('_' + name)
+            if isinstance(v, ChildrenField):
+                names.add(children_cache_key(name))
+            elif isinstance(v, FileField):
+                names.add(file_handle_key(name))
+        return tuple(sorted(name for name in names
+                            if not any(hasattr(b, name) for b in bases)))
+
+# Attributes of model objects besides the fields
+model_internal_attrs = ('_dirty_keys', '_pushes', '_prefetched',
+                        '_deferred', '_deferred_batch', '_file_deletes',
+                        '_lazy')
+
 class Model(object):
     """ The model of couchdb
     A model defines the schema of a database using its fields
@@ -463,7 +3199,28 @@ class Model(object):
     """
     __metaclass__ = ModelMeta
     index_list = []
+    # Index objects, see sync_indexes
+    indexes = []
     use_obj_cache = True
+    # Options passed to make_obj_cache, merged over the options of
+    # the base classes, e.g. {'policy': 'lfu', 'ttl': 300}
+    obj_cache_options = {'policy': 'lru', 'max_size': 10000}
+    # Seconds to share the counts of the same conditions
+    count_cache_ttl = None
+    # Store fields in __slots__ to save memory of objects
+    use_slots = False
+    # Read documents as raw bson and decode the fields on first
+    # access, requires pymongo >= 3
+    lazy_bson = False
+    # Read preference of find and count, e.g.
+    # pymongo.ReadPreference.SECONDARY_PREFERRED
+    __read_preference__ = None
+    # Write concern of the collection, e.g. {'w': 0} for fire and
+    # forget writes or {'w': 'majority', 'j': True}
+    __write_concern__ = None
+    # Options of the WriteBehindBuffer used by save_later, e.g.
+    # {'max_size': 500, 'max_age': 2}
+    write_behind_options = {}
 
     def __str__(self):
         """
@@ -481,7 +3238,10 @@ class Model(object):
         Called in ModelMeta's __new__
         """
         if cls.use_obj_cache:
-            cls.obj_cache = {}
+            options = {}
+            for klass in reversed(cls.__mro__):
+                options.update(vars(klass).get('obj_cache_options', {}))
+            cls.obj_cache = make_obj_cache(**options)
         cache_classes.add(cls)
 
         cls.col_name = cls.__name__.lower()
@@ -489,33 +3249,133 @@ class Model(object):
         cls.id = idfield
         cls.fields = [idfield]
         cls.field_map = {}
+        cls.key_map = {}
+        cls.children_fields = []
         for fieldname, v in vars(cls).items():
             if isinstance(v, Field):
                 v.fieldname = fieldname
                 cls.fields.append(v)
                 cls.field_map[fieldname] = v
+                cls.key_map[v.get_key()] = v
+                if isinstance(v, ChildrenField):
+                    cls.children_fields.append(v)
+                if isinstance(v, SequenceField) and v.block_size:
+                    sequence_allocator.set_block_size(v.key, v.block_size)
+        cls.loader = staticmethod(cls.make_loader())
+
+    @classmethod
+    def invalidate_cache(cls, objids=None, publish=True):
+        """ Evict the given objects from the object cache, evict
+        all of the class if objids is None. The eviction is published
+        to other processes if an invalidation bus is set
+        """
+        if not cls.use_obj_cache:
+            return
+        if objids is None:
+            cls.obj_cache.clear()
+        else:
+            objids = list(objids)
+            for objid in objids:
+                cls.obj_cache.pop(objid, None)
+        if publish and invalidation_bus is not None:
+            try:
+                invalidation_bus.publish(cls, objids)
+            except Exception:
+                logger.exception('failed to publish the invalidation of %s',
+                                 cls.__name__)
 
     @classmethod
     def ensure_indices(cls):
         ''' It's better to use js instead of this functions'''
         col = cls.collection()
         for idx, kwargs in cls.index_list:
-            col.ensure_index(idx, **kwargs)
+            col.create_index(idx, **kwargs)
+
+    @classmethod
+    def sync_indexes(cls, drop=False):
+        """ Create the indexes of cls.indexes missing or changed in
+        the collection, drop the indexes declared neither there nor
+        in cls.index_list if drop is True.
+        Return {'created': [names], 'dropped': [names]}
+        """
+        col = cls.collection()
+        live = col.index_information()
+        created = []
+        dropped = []
+        declared = set()
+        legacy_keys = []
+        for idx, kwargs in cls.index_list:
+            if 'name' in kwargs:
+                declared.add(kwargs['name'])
+            if isinstance(idx, basestring):
+                idx = [(idx, ASCENDING)]
+            legacy_keys.append([tuple(k) for k in idx])
+        for index in cls.indexes:
+            name = index.get_name(cls)
+            declared.add(name)
+            info = live.get(name)
+            if info is not None:
+                if index.matches(cls, info):
+                    continue
+                col.drop_index(name)
+                dropped.append(name)
+            col.create_index(index.get_keys(cls), **index.get_options(cls))
+            created.append(name)
+        if drop:
+            for name, info in live.iteritems():
+                if name == '_id_' or name in declared:
+                    continue
+                if [tuple(k) for k in info.get('key', ())] in legacy_keys:
+                    continue
+                col.drop_index(name)
+                dropped.append(name)
+        if created or dropped:
+            logger.info('indexes of %s created %s dropped %s',
+                        cls.__name__, created, dropped)
+        return {'created': created, 'dropped': dropped}
 
     @classmethod
     def get_auto_incr_value(cls):
         pass
 
     @classmethod
-    def collection(cls):
+    def collection(cls, read=False, raw=False):
+        """ Get the collection of the model, reads go through the
+        read preference of the model if read is True while writes
+        always go to the primary with the write concern of the model.
+        Documents are read as raw bson if raw is True and pymongo
+        supports it, see lazy_bson
+        """
+        check_fork()
         database = getattr(cls, '__database__', default_db)
-        server = get_server(*database)
-        return server[cls.col_name]
+        read_preference = read and cls.__read_preference__ or None
+        raw = raw and raw_codec_options is not None
+        key = (cls, database, read_preference, raw)
+        col = _collection_pool.get(key)
+        if col is None:
+            col = get_database(database)[cls.col_name]
+            if read_preference is not None:
+                if hasattr(col, 'with_options'):
+                    col = col.with_options(read_preference=read_preference)
+                else:
+                    col.read_preference = read_preference
+            if cls.__write_concern__ is not None:
+                if WriteConcern is not None:
+                    col = col.with_options(
+                        write_concern=WriteConcern(**cls.__write_concern__))
+                else:
+                    col.write_concern = cls.__write_concern__
+            if raw:
+                col = col.with_options(codec_options=raw_codec_options)
+            _collection_pool[key] = col
+        if instrumentation is not None:
+            return InstrumentedCollection(col, cls, instrumentation)
+        return col
 
     @classmethod
     def recycle_collection(cls):
         database = getattr(cls, '__database__', default_db)
-        server = get_server(*database)
+        server = get_database(database)
         return server['%s_recycle' % cls.col_name]
 
     def create(cls, **kwargs):
@@ -546,6 +3406,18 @@ class Model(object):
             cols.append((f, order))
         return cols
 
+    @classmethod
+    def get_field_key(cls, fieldname):
+        """ Get the db key of a field name, the first part of a
+        dotted name is translated, e.g. 'comments.author'
+        """
+        name, dot, rest = fieldname.partition('.')
+        if name == 'id':
+            name = '_id'
+        elif name in cls.field_map:
+            name = cls.field_map[name].get_key()
+        return name + dot + rest
+
     @classmethod
     def make_sort_dict(cls, fields):
         cols = {}
@@ -563,6 +3435,15 @@ class Model(object):
             cols[f] = order
         return cols
 
+    @classmethod
+    def get_key_value(cls, obj, key):
+        """ Get the raw value of obj stored under the db key
+        """
+        field = cls.key_map.get(key)
+        if field is None:
+            return getattr(obj, key, None)
+        return field.get_raw(obj)
+
     @classmethod
     def filter_condition(cls, conditions):
         newcondition = {}
@@ -577,13 +3458,90 @@ class Model(object):
             newcondition[k] = v
         return newcondition
 
+    @classmethod
+    def export(cls, stream, format='bson', query=None, sort=None,
+               compress=False, files_stream=None):
+        """ Export the documents of query, a dict of field names,
+        ordered by sort, a list of field names, see CursorWrapper.export
+        """
+        wrapper = cls.find(**(query or {}))
+        if sort:
+            wrapper = wrapper.sort(*sort)
+        return wrapper.export(stream, format=format, compress=compress,
+                              files_stream=files_stream)
+
+    @classmethod
+    def import_(cls, stream, format='bson', batch_size=1000,
+                compress=None, upsert=False, files_stream=None):
+        """ Insert the documents of an export in bulk batches, or
+        replace the documents of the same _id if upsert is True.
+        Gzipped streams are detected if compress is None and the
+        stream is seekable. Return a BulkResult.
+        """
+        assert format in export_formats, 'unknown format %r' % format
+        if files_stream is not None:
+            import_files(cls, files_stream, format=format,
+                         compress=compress)
+        if compress or (compress is None and is_gzip_stream(stream)):
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+        col = cls.collection()
+        result = BulkResult()
+        for batch in iter_chunks(read_export_stream(stream, format),
+                                 batch_size):
+            bulk_write_documents(col, batch, result, upsert=upsert)
+            if upsert:
+                cls.invalidate_cache([doc['_id'] for doc in batch
+                                      if '_id' in doc])
+        return result
+
+    @classmethod
+    def make_update(cls, set=None, unset=None, inc=None, push=None,
+                    add_to_set=None, pull=None, set_on_insert=None):
+        """ Make an update document of field names, the values are
+        coerced by the fields. set, inc, set_on_insert and pull are
+        dicts of name -> value, unset is a list of names, a list or
+        tuple pushed or added to set is pushed item by item.
+        """
+        update = {}
+        def add(op, values, coerce):
+            if not values:
+                return
+            doc = update.setdefault(op, {})
+            for name, value in values.iteritems():
+                field = cls.field_map.get(name)
+                if field is None and isinstance(value, Model):
+                    value = value.id
+                if coerce is not None:
+                    value = coerce(field, value)
+                doc[cls.get_field_key(name)] = value
+
+        def coerce_value(field, value):
+            if field is None:
+                return value
+            return field.coerce(value)
+
+        def coerce_items(field, value):
+            coerce_item = getattr(field, 'coerce_item', lambda v: v)
+            if isinstance(value, (list, tuple)):
+                return {'$each': [coerce_item(v) for v in value]}
+            return coerce_item(value)
+
+        add('$set', set, coerce_value)
+        add('$setOnInsert', set_on_insert, coerce_value)
+        add('$inc', inc, coerce_value)
+        add('$push', push, coerce_items)
+        add('$addToSet', add_to_set, coerce_items)
+        add('$pull', pull, None)
+        if unset:
+            update['$unset'] = dict((cls.get_field_key(name), '')
+                                    for name in unset)
+        return update
+
     @classmethod
     def find_and_modify(cls, query=None, update=None, sort=None, upsert=False, new=False):
         """
         Atomic find and modify
         """
-        if cls.use_obj_cache:
-            cls.obj_cache = {}
         col = cls.collection()
         query = cls.filter_condition(query)
         sort = cls.make_sort_dict(sort)
@@ -593,6 +3551,7 @@ class Model(object):
                                        sort=sort,
                                        upsert=upsert, new=new)
         if datadict:
+            cls.invalidate_cache([datadict['_id']])
             return cls.get_from_data(datadict)
 
     @classmethod
@@ -608,8 +3567,6 @@ class Model(object):
         """
         Atomic way to dequeue an object
         """
-        if cls.use_obj_cache:
-            cls.obj_cache = {}
         col = cls.collection()
         query = cls.filter_condition(query)
         sort = cls.make_sort_dict(sort)
@@ -617,6 +3574,7 @@ class Model(object):
                                        sort=sort,
                                        remove=True)
         if datadict:
+            cls.invalidate_cache([datadict['_id']])
             return cls.get_from_data(datadict)
 
     @classmethod
@@ -625,34 +3583,59 @@ class Model(object):
         return CursorWrapper(cls, conditions=conditions)
 
     @classmethod
-    def find_one(cls, **conditions):
-        conditions = cls.filter_condition(conditions)
-        col = cls.collection()
-        datadict = col.find_one(conditions)
+    def find_one(cls, _only=None, _defer=None, **conditions):
+        """ Find one object, only the fields in _only are loaded
+        if given, the fields in _defer are not loaded until they are
+        accessed
+        """
+        wrapper = cls.find(**conditions)
+        if _only is not None:
+            wrapper = wrapper.only(*_only)
+        if _defer is not None:
+            wrapper = wrapper.defer(*_defer)
+        col = cls.collection(read=True, raw=cls.lazy_bson)
+        if query_check_mode is not None:
+            check_query(cls, col.find(wrapper.conditions),
+                        wrapper.conditions, [])
+        datadict = col.find_one(wrapper.conditions,
+                                wrapper.get_projection())
         if datadict:
-            return cls.get_from_data(datadict)
+            return wrapper.hydrate(datadict)
         else:
             return datadict
 
     @classmethod
     def count(cls):
-        return cls.collection().count()
+        return cls.collection(read=True).count()
 
     @classmethod
     def remove(cls, **conditions):
-        if cls.use_obj_cache:
-            cls.obj_cache = {}
         conditions = cls.filter_condition(conditions)
-        return cls.collection().remove(conditions)
+        ret = cls.collection().remove(conditions)
+        cls.invalidate_cache(cls.condition_ids(conditions))
+        return ret
+
+    @classmethod
+    def condition_ids(cls, conditions):
+        """ Get the object ids that conditions are restricted to,
+        None if it's not restricted to ids
+        """
+        objid = conditions.get('_id')
+        if isinstance(objid, ObjectId):
+            return [objid]
+        elif isinstance(objid, dict) and objid.keys() == ['$in']:
+            return list(objid['$in'])
+        return None
 
     def erase(self):
-        if self.use_obj_cache:
-            self.__class__.obj_cache.pop(self._id, None)
         modelsignal.will_erase.send(self.__class__,
                                     instance=self)
-        return self.collection().remove({'_id': self._id})
+        ret = self.collection().remove({'_id': self._id})
+        self.invalidate_cache([self._id])
+        return ret
 
     def recycle(self):
+        self.check_loaded()
         col = self.recycle_collection()
         objid = col.save(self.get_dict())
         assert objid == self._id
@@ -668,6 +3651,7 @@ class Model(object):
         if obj:
             col = cls.collection()
             col.save(obj)
+            cls.invalidate_cache([objid])
             obj = cls.get(objid)
             modelsignal.revived.send(cls,
                                      instance=obj)
@@ -676,19 +3660,75 @@ class Model(object):
     @classmethod
     def multi_get(cls, objid_list, exclude_null=True):
         """ Get multiple objects in batch mode to reduce the time
-        spent on network traffic
+        spent on network traffic, cached objects are not queried
         """
         obj_dict = {}
-        for obj in cls.find(_id={'$in': objid_list}):
-            obj_dict[obj._id] = obj
-            if cls.use_obj_cache:
-                cls.obj_cache[obj._id] = obj
+        missing = objid_list
+        if cls.use_obj_cache:
+            missing = []
+            for objid in objid_list:
+                obj = cls.obj_cache.get(objid)
+                if obj is None:
+                    missing.append(objid)
+                else:
+                    obj_dict[objid] = obj
+        if missing:
+            for obj in cls.find(_id={'$in': missing}).iterator():
+                obj_dict[obj._id] = obj
+                if cls.use_obj_cache:
+                    cls.obj_cache.set(obj._id, obj)
 
         for objid in objid_list:
             obj = obj_dict.get(objid)
             if obj or not exclude_null:
                 yield obj
 
+    @classmethod
+    def prefetch_related(cls, objs, *fieldnames):
+        """ Resolve the references of fieldnames on objs with one
+        $in query per referenced class, the resolved objects are
+        attached to objs and used by ReferenceField on access
+        """
+        prefetched = {}
+        for fieldname in fieldnames:
+            cls.resolve_related(objs, fieldname, prefetched)
+        for obj in objs:
+            old = getattr(obj, '_prefetched', None)
+            if old is not None and old is not prefetched:
+                prefetched.update(old)
+            obj._prefetched = prefetched
+            for field in cls.children_fields:
+                cache = getattr(obj, field.get_cache_key(), None)
+                if cache is not None:
+                    for child in cache.children:
+                        child._prefetched = prefetched
+
+    @classmethod
+    def resolve_related(cls, objs, fieldname, prefetched):
+        name, _, subname = fieldname.partition('.')
+        field = cls.field_map[name]
+        if isinstance(field, ChildrenField):
+            if not subname:
+                raise ValueError('A reference of %s is required' % name)
+            children = []
+            for obj in objs:
+                children.extend(getattr(obj, name))
+            child_cls = field.get_child_class(None)
+            child_cls.resolve_related(children, subname, prefetched)
+        elif isinstance(field, ReferenceField):
+            if subname:
+                raise ValueError('Can not prefetch through %s' % name)
+            objids = defaultdict(set)
+            for obj in objs:
+                objid = field.get_raw(obj)
+                if objid is not None and objid not in prefetched:
+                    objids[field.get_ref_class(obj)].add(objid)
+            for ref_cls, ids in objids.iteritems():
+                for ref in ref_cls.multi_get(list(ids)):
+                    prefetched[ref.id] = ref
+        else:
+            raise ValueError('%s is not a reference' % name)
+
     @classmethod
     def get(cls, objid):
         """ Get an object by objectid
@@ -704,18 +3744,46 @@ class Model(object):
 
         if cls.use_obj_cache:
             obj =  cls.obj_cache.get(objid)
-            if obj:
+            if obj is not None:
                 return obj
 
-        col = cls.collection()
+        col = cls.collection(read=True, raw=cls.lazy_bson)
         kw = {'_id': objid}
         datadict = col.find_one(kw)
         if datadict is not None:
-            obj = cls(**force_string_keys(datadict))
+            obj = cls.get_from_data(datadict)
             if cls.use_obj_cache:
-                cls.obj_cache[objid] = obj
+                cls.obj_cache.set(objid, obj)
             return obj
 
+    # Asyncio variants, return futures to be awaited
+    @classmethod
+    def aget(cls, objid):
+        return run_async(cls.get, objid)
+
+    @classmethod
+    def amulti_get(cls, objid_list, exclude_null=True):
+        return run_async(lambda: list(cls.multi_get(objid_list,
+                                                    exclude_null)))
+
+    @classmethod
+    def afind_one(cls, **conditions):
+        return run_async(cls.find_one, **conditions)
+
+    @classmethod
+    def afind_and_modify(cls, **kwargs):
+        return run_async(cls.find_and_modify, **kwargs)
+
+    @classmethod
+    def afind_and_remove(cls, **kwargs):
+        return run_async(cls.find_and_remove, **kwargs)
+
+    def asave(self):
+        return run_async(self.save)
+
+    def aerase(self):
+        return run_async(self.erase)
+
     def __eq__(self, other):
         return (self.__class__ == other.__class__ and
                 self.id and other.id and
@@ -733,14 +3801,51 @@ class Model(object):
         try to call User.save directly or code some where.
         Think it over.
         """
+        cls = self.__class__
         new = self.id is None
         col = self.collection()
 
+        self.fill_auto_fields(new)
+        if new:
+            if modelsignal.pre_create.has_handlers(cls):
+                modelsignal.pre_create.send(cls, instance=self)
+        elif modelsignal.pre_update.has_handlers(cls):
+            modelsignal.pre_update.send(cls, instance=self)
+        if new:
+            self.id = col.save(self.get_dict())
+        else:
+            update = self.get_update_dict()
+            if update:
+                ret = col.update({'_id': self.id}, update)
+                # Unacknowledged writes return no result
+                if ret is not None and not ret.get('n'):
+                    self.write_missing(col)
+                # Evict after writing so that other processes can not
+                # load the old document again
+                self.invalidate_cache([self.id])
+        self.clear_dirty()
+        self.delete_replaced_files()
+        if new:
+            self.on_created()
+            if modelsignal.post_create.has_handlers(cls):
+                modelsignal.post_create.send(cls, instance=self)
+        elif modelsignal.post_update.has_handlers(cls):
+            modelsignal.post_update.send(cls, instance=self)
+
+    def fill_auto_fields(self, new, sequences=None):
+        """ Fill sequence and auto datetime fields before saving,
+        sequences is an optional dict of key -> iterator of
+        reserved sequence values
+        """
         for field in self.fields:
             if new:
                 if (isinstance(field, SequenceField) and
                     not getattr(self, field.fieldname, None)):
-                    setattr(self, field.fieldname, SequenceModel.get_next(field.key))
+                    if sequences is not None:
+                        value = next(sequences[field.key])
+                    else:
+                        value = SequenceModel.get_next(field.key)
+                    setattr(self, field.fieldname, value)
             if isinstance(field, DateTimeField):
                 if field.auto_now:
                     setattr(self, field.fieldname, utc_now())
@@ -748,28 +3853,319 @@ class Model(object):
                       and new
                       and not getattr(self, field.fieldname, None)):
                     setattr(self, field.fieldname, utc_now())
-        if new:
-            modelsignal.pre_create.send(self.__class__,
-                                   instance=self)
-        else:
-            modelsignal.pre_update.send(self.__class__, instance=self)
-            if self.use_obj_cache:
-                self.__class__.obj_cache.pop(self.id, None)
-        self.id = col.save(self.get_dict())
-        if new:
-            self.on_created()
-            modelsignal.post_create.send(self.__class__,
-                                    instance=self)
+
+    @classmethod
+    def bulk_save(cls, objs, batch_size=1000, ordered=True,
+                  signal='object'):
+        """ Save objects in batches of bulk write operations, new
+        objects are inserted and changed ones are updated.
+
+        signal is 'object' to send the pre/post signals per object,
+        'batch' to send them once per batch with the keyword
+        argument instances, or None to send no signals.
+
+        Errors are collected per batch in the returned BulkResult,
+        an ordered bulk save stops at the first failed batch.
+        """
+        result = BulkResult()
+        # Deferred and batch handlers run once after all batches
+        with signal_scope():
+            for batch in iter_chunks(objs, batch_size):
+                cls.save_batch(batch, result, ordered=ordered,
+                               signal=signal)
+                if ordered and result.errors:
+                    break
+        return result
+
+    @classmethod
+    def bulk_create(cls, objs, batch_size=1000, ordered=True,
+                    signal='object'):
+        """ Insert new objects in batches, see bulk_save
+        """
+        def check_new(objs):
+            for obj in objs:
+                assert obj.id is None, 'bulk_create on a saved object'
+                yield obj
+        return cls.bulk_save(check_new(objs), batch_size=batch_size,
+                             ordered=ordered, signal=signal)
+
+    @classmethod
+    def save_batch(cls, batch, result, ordered=True, signal='object'):
+        new_objs = [obj for obj in batch if obj.id is None]
+        old_objs = [obj for obj in batch if obj.id is not None]
+
+        # Reserve a block of values for every sequence
+        sequences = {}
+        for field in cls.fields:
+            if isinstance(field, SequenceField):
+                count = len([obj for obj in new_objs
+                             if not getattr(obj, field.fieldname, None)])
+                if count:
+                    start = SequenceModel.reserve(field.key, count)
+                    sequences[field.key] = iter(xrange(start, start + count))
+        for obj in new_objs:
+            obj.fill_auto_fields(True, sequences=sequences)
+        for obj in old_objs:
+            obj.fill_auto_fields(False)
+
+        if signal == 'object':
+            # Skip the loops when no handler receives the signals
+            if modelsignal.pre_create.has_handlers(cls):
+                for obj in new_objs:
+                    modelsignal.pre_create.send(cls, instance=obj)
+            if modelsignal.pre_update.has_handlers(cls):
+                for obj in old_objs:
+                    modelsignal.pre_update.send(cls, instance=obj)
+        elif signal == 'batch':
+            if new_objs:
+                modelsignal.pre_create.send(cls, instances=new_objs)
+            if old_objs:
+                modelsignal.pre_update.send(cls, instances=old_objs)
+
+        col = cls.collection()
+        if ordered:
+            bulk = col.initialize_ordered_bulk_op()
         else:
-            modelsignal.post_update.send(self.__class__,
-                                    instance=self)
+            bulk = col.initialize_unordered_bulk_op()
+        ops = []
+        failed = set()
+        try:
+            for obj in new_objs:
+                obj.id = ObjectId()
+                bulk.insert(obj.get_dict())
+                ops.append(obj)
+            for obj in old_objs:
+                update = obj.get_update_dict()
+                if update:
+                    bulk.find({'_id': obj.id}).update_one(update)
+                    ops.append(obj)
+
+            if ops:
+                try:
+                    # Unacknowledged writes return no result
+                    ret = bulk.execute() or {}
+                except BulkWriteError, e:
+                    ret = e.details
+                    result.errors.append((result.batches, e))
+                    failed = set(err['index'] for err in ret['writeErrors'])
+                    if ordered and failed:
+                        # Operations after the first error are not executed
+                        failed.update(xrange(min(failed), len(ops)))
+                result.inserted += ret.get('nInserted', 0)
+                result.updated += (ret.get('nModified', 0) or 0)
+                result.upserted += ret.get('nUpserted', 0)
+        except Exception:
+            # The new objects are not known to be inserted, they are
+            # inserted again by the next save
+            for obj in new_objs:
+                if obj.id is not None:
+                    del obj.id
+            raise
+        result.batches += 1
+        # Unchanged objects are neither written nor evicted
+        if len(ops) > len(new_objs):
+            cls.invalidate_cache([obj.id for obj in ops[len(new_objs):]])
+
+        failed_objs = set(id(ops[i]) for i in failed)
+        update_objs = [obj for obj in ops[len(new_objs):]
+                       if id(obj) not in failed_objs]
+        if (update_objs and
+            ret.get('nMatched', len(update_objs)) < len(update_objs)):
+            ids = [obj.id for obj in update_objs]
+            found = set(d['_id'] for d in col.find({'_id': {'$in': ids}},
+                                                   ['_id']))
+            for obj in update_objs:
+                if obj.id not in found:
+                    obj.write_missing(col)
+                    result.upserted += 1
+        created = []
+        for obj in new_objs:
+            if id(obj) in failed_objs:
+                del obj.id
+            else:
+                obj.clear_dirty()
+                obj.delete_replaced_files()
+                created.append(obj)
+        updated = []
+        for obj in old_objs:
+            if id(obj) not in failed_objs:
+                obj.clear_dirty()
+                obj.delete_replaced_files()
+                updated.append(obj)
+        result.failed += len(failed_objs)
+
+        for obj in created:
+            obj.on_created()
+        if signal == 'object':
+            if modelsignal.post_create.has_handlers(cls):
+                for obj in created:
+                    modelsignal.post_create.send(cls, instance=obj)
+            if modelsignal.post_update.has_handlers(cls):
+                for obj in updated:
+                    modelsignal.post_update.send(cls, instance=obj)
+        elif signal == 'batch':
+            if created:
+                modelsignal.post_create.send(cls, instances=created)
+            if updated:
+                modelsignal.post_update.send(cls, instances=updated)
+
+    def write_missing(self, col):
+        """ Write the whole object when its document is missing,
+        either deleted meanwhile or never stored under a preset id
+        """
+        self.check_loaded()
+        col.save(self.get_dict())
+
+    def save_later(self):
+        """ Queue a new object to be inserted by the write behind
+        buffer of the model, returns False if it is dropped
+        """
+        return self.write_behind_buffer().add(self)
+
+    @classmethod
+    def write_behind_buffer(cls):
+        buf = write_behind_buffers.get(cls)
+        if buf is None:
+            with write_behind_lock:
+                buf = write_behind_buffers.get(cls)
+                if buf is None:
+                    buf = WriteBehindBuffer(cls, **cls.write_behind_options)
+                    write_behind_buffers[cls] = buf
+        return buf
 
     def on_created(self):
         pass
 
+    def delete_replaced_files(self):
+        """ Delete the GridFS files replaced since last save
+        """
+        deletes = getattr(self, '_file_deletes', None)
+        if not deletes:
+            return
+        self._file_deletes = None
+        fs = FileField.get_fs(self)
+        for objid in deletes:
+            fs.delete(objid)
+
+    def is_partial(self):
+        """ Whether some fields of the object are not loaded
+        """
+        return bool(getattr(self, '_deferred', None))
+
+    def check_loaded(self, keys=None):
+        """ Refuse to write fields that are neither loaded nor
+        assigned, or any field when keys is None
+        """
+        deferred = getattr(self, '_deferred', None)
+        if not deferred:
+            return
+        deferred_keys = set(self.field_map[fieldname].get_key()
+                            for fieldname in deferred)
+        if keys is not None:
+            deferred_keys.intersection_update(keys)
+        if deferred_keys:
+            raise PartialObjectError(
+                'Fields %s of %s are not loaded' % (
+                    ', '.join(sorted(deferred_keys)), self.__class__.__name__))
+
+    def load_deferred(self, *fieldnames):
+        """ Load the deferred fieldnames, or all deferred fields if
+        none is given. Objects of the same batch are loaded together
+        if the results are batch deferred.
+        """
+        if not fieldnames:
+            fieldnames = tuple(self._deferred)
+        fieldnames = set(fieldnames)
+        objs = getattr(self, '_deferred_batch', None) or [self]
+        obj_map = dict((obj.id, obj) for obj in objs
+                       if obj._deferred & fieldnames)
+        obj_map[self.id] = self
+        fields = [self.field_map[fieldname] for fieldname in fieldnames]
+        projection = dict((field.get_key(), 1) for field in fields)
+        col = self.collection(read=True)
+        for datadict in col.find({'_id': {'$in': obj_map.keys()}},
+                                 projection):
+            obj = obj_map[datadict['_id']]
+            dirty = getattr(obj, '_dirty_keys', ())
+            for field in fields:
+                key = field.get_key()
+                if (field.fieldname in obj._deferred and
+                    key in datadict and key not in dirty):
+                    # Stored directly like the loaders do, setters
+                    # such as FileField's read the field again
+                    obj._deferred.discard(field.fieldname)
+                    setattr(obj, field.get_obj_key(), datadict[key])
+        for obj in obj_map.itervalues():
+            obj._deferred.difference_update(fieldnames)
+
+    def mark_dirty(self, *fieldnames):
+        """ Mark fields changed, for changes that can not be
+        tracked such as modifying a dict inside an ArrayField
+        """
+        for fieldname in fieldnames:
+            _mark_dirty(self, self.field_map[fieldname].get_key())
+
+    def clear_dirty(self):
+        self._dirty_keys = set()
+        self._pushes = None
+        for field in self.children_fields:
+            cache = getattr(self, field.get_cache_key(), None)
+            if cache is not None:
+                for child in cache.children:
+                    child.clear_dirty()
+
+    def sync_children(self):
+        for field in self.children_fields:
+            field.sync(self)
+
+    def get_update_dict(self):
+        """ Get the $set/$unset/$push update of the changed fields
+        """
+        self.sync_children()
+        sets = {}
+        unsets = {}
+        dirty = getattr(self, '_dirty_keys', ())
+        pushes = getattr(self, '_pushes', None) or {}
+        self.check_loaded(dirty)
+        rewrites = set()
+        for key in dirty:
+            if key == '_id':
+                continue
+            basekey, _, index = key.partition('.')
+            if index:
+                # Positional update of an array
+                if basekey in dirty:
+                    continue
+                if basekey in pushes:
+                    # Can not $set and $push the same array at once
+                    rewrites.add(basekey)
+                    continue
+                sets[key] = self.key_map[basekey].get_raw(self)[int(index)]
+                continue
+            value = self.key_map[key].get_raw(self)
+            if value is None:
+                unsets[key] = 1
+            else:
+                sets[key] = value
+        for key in rewrites:
+            for setkey in sets.keys():
+                if setkey.startswith(key + '.'):
+                    del sets[setkey]
+            sets[key] = self.key_map[key].get_raw(self)
+        update = {}
+        if sets:
+            update['$set'] = sets
+        if unsets:
+            update['$unset'] = unsets
+        for key, docs in pushes.iteritems():
+            if key not in dirty and key not in rewrites:
+                update.setdefault('$push', {})[key] = {'$each': docs}
+        return update
+
     def get_dict(self):
         """ Get the dict representation of an object's fields
         """
+        self.sync_children()
         info_dict = {}
         for field in self.fields:
             key = field.get_key()
@@ -781,21 +4177,298 @@ class Model(object):
 
     @classmethod
     def get_from_data(cls, datadict):
-        datadict = force_string_keys(datadict)
-        return cls(**datadict)
+        """ Make an object of the document read from db
+        """
+        return cls.loader(datadict)
+
+    @classmethod
+    def make_loader(cls):
+        """ Make the loader of documents read from db. Values from
+        db are trusted, they are stored into the objects directly
+        instead of being coerced by the fields.
+        """
+        if cls.__init__.im_func is not Model.__init__.im_func:
+            # Custom __init__ has to be called
+            def load_by_init(datadict):
+                obj = cls(**force_string_keys(datadict))
+                obj.clear_dirty()
+                return obj
+            return load_by_init
+
+        obj_keys = {}
+        for field in cls.fields:
+            obj_keys[field.get_key()] = field.get_obj_key()
+            obj_keys[unicode(field.get_key())] = field.get_obj_key()
+        new = object.__new__
+
+        if cls.use_slots:
+            setters = dict((key, getattr(cls, obj_key).__set__)
+                           for key, obj_key in obj_keys.iteritems())
+            def load_slots(datadict):
+                obj = new(cls)
+                for key, value in datadict.iteritems():
+                    setter = setters.get(key)
+                    if setter is None:
+                        setattr(obj, key.encode('utf-8'), value)
+                    else:
+                        setter(obj, value)
+                obj._dirty_keys = set()
+                return obj
+            eager = load_slots
+        else:
+            def load(datadict):
+                obj = new(cls)
+                d = obj.__dict__
+                for key, value in datadict.iteritems():
+                    obj_key = obj_keys.get(key)
+                    if obj_key is None:
+                        obj_key = key.encode('utf-8')
+                    d[obj_key] = value
+                d['_dirty_keys'] = set()
+                return obj
+            eager = load
+
+        if not cls.lazy_bson:
+            return eager
+
+        def load_lazy(datadict):
+            raw = getattr(datadict, 'raw', None)
+            if raw is None:
+                # Decoded documents, e.g. of find_and_modify
+                return eager(datadict)
+            obj = new(cls)
+            obj._lazy = lazy = LazyDocument(raw)
+            obj._id = lazy.pop('_id')
+            obj._dirty_keys = set()
+            return obj
+        return load_lazy
 
     def __init__(self, **kwargs):
         for key, value in kwargs.iteritems():
             setattr(self, key, value)
 
+class SequenceAllocator(object):
+    """ Hi-lo allocator of sequence values.
+    A block of values is reserved on the sequence document in one
+    round trip and handed out locally. Blocks reserved before a fork
+    belong to the parent process, the child reserves its own.
+    """
+    def __init__(self):
+        self.block_sizes = {}
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # key -> [next value, last value]
+        self.ranges = {}
+
+    def set_block_size(self, key, block_size):
+        self.block_sizes[key] = block_size
+
+    def next(self, key):
+        if self.pid != os.getpid():
+            self.reset()
+        with self.lock:
+            rng = self.ranges.get(key)
+            if rng is None or rng[0] > rng[1]:
+                block_size = self.block_sizes.get(key, 1)
+                start = SequenceModel.reserve(key, block_size)
+                rng = [start, start + block_size - 1]
+                self.ranges[key] = rng
+            value = rng[0]
+            rng[0] += 1
+            return value
+
+    def wasted(self):
+        """ Get the number of reserved but unused values per key
+        """
+        if self.pid != os.getpid():
+            return {}
+        return dict((key, rng[1] - rng[0] + 1)
+                    for key, rng in self.ranges.iteritems()
+                    if rng[0] <= rng[1])
+
+sequence_allocator = SequenceAllocator()
+
+@atexit.register
+def report_wasted_sequences():
+    for key, count in sequence_allocator.wasted().iteritems():
+        logger.info('%d reserved values of sequence %r are wasted',
+                    count, key)
+
+class WriteBehindBuffer(object):
+    """ Buffer new objects of model and insert them by bulk_save in a
+    background thread once max_size objects are pending, once the
+    oldest one has waited max_age seconds, or at exit. Signals and
+    on_created of the objects happen at flush time in the flushing
+    thread.
+
+    When max_pending objects are waiting, add blocks up to timeout
+    seconds for room if block is True, otherwise the object is
+    dropped. Dropped and failed writes are logged and counted in
+    stats().
+    """
+    def __init__(self, model, max_size=1000, max_age=1.0,
+                 max_pending=10000, block=True, timeout=None,
+                 ordered=False, signal='object'):
+        self.model = model
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_pending = max(max_pending, max_size)
+        self.block = block
+        self.timeout = timeout
+        self.ordered = ordered
+        self.signal = signal
+        self.counts = {'added': 0, 'inserted': 0, 'failed': 0,
+                       'dropped': 0, 'flushes': 0}
+        self.last_error = None
+        self.reset()
+
+    def reset(self):
+        # Objects queued before fork are flushed by the parent
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.room = threading.Condition(self.lock)
+        self.pending = []
+        self.first_at = None
+        self.thread = None
+
+    def add(self, obj):
+        """ Queue a new object, returns False if it is dropped
+        """
+        assert obj.id is None, 'save_later on a saved object'
+        if self.pid != os.getpid():
+            self.reset()
+        # Creation time is the time of add, not of the flush
+        for field in obj.fields:
+            if (isinstance(field, DateTimeField) and
+                field.auto_now_add and
+                not getattr(obj, field.fieldname, None)):
+                setattr(obj, field.fieldname, utc_now())
+
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                if not self.wait_room():
+                    self.counts['dropped'] += 1
+                    logger.warning('write behind buffer of %s is full, '
+                                   'object dropped', self.model.__name__)
+                    return False
+            self.pending.append(obj)
+            self.counts['added'] += 1
+            if self.first_at is None:
+                self.first_at = time.time()
+            if len(self.pending) >= self.max_size:
+                self.ready.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run,
+                    name='mongopie-write-behind-%s' % self.model.col_name)
+                self.thread.daemon = True
+                self.thread.start()
+        return True
+
+    def wait_room(self):
+        if not self.block:
+            return False
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while len(self.pending) >= self.max_pending:
+            if deadline is None:
+                self.room.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.room.wait(remaining)
+        return True
+
+    def run(self):
+        while True:
+            with self.lock:
+                while True:
+                    if len(self.pending) >= self.max_size:
+                        break
+                    if self.first_at is None:
+                        self.ready.wait()
+                        continue
+                    remaining = self.first_at + self.max_age - time.time()
+                    if remaining <= 0:
+                        break
+                    self.ready.wait(remaining)
+            self.flush()
+
+    def flush(self):
+        """ Insert the pending objects now, returns the BulkResult
+        or None if nothing is inserted
+        """
+        if self.pid != os.getpid():
+            return None
+        with self.flush_lock:
+            with self.lock:
+                batch = self.pending
+                self.pending = []
+                self.first_at = None
+                self.room.notify_all()
+            if not batch:
+                return None
+            try:
+                result = self.model.bulk_save(batch,
+                                              batch_size=self.max_size,
+                                              ordered=self.ordered,
+                                              signal=self.signal)
+            except Exception, e:
+                logger.exception('write behind of %d objects of %s failed',
+                                 len(batch), self.model.__name__)
+                with self.lock:
+                    self.counts['failed'] += len(batch)
+                    self.counts['flushes'] += 1
+                    self.last_error = e
+                return None
+            with self.lock:
+                self.counts['inserted'] += len(batch) - result.failed
+                self.counts['failed'] += result.failed
+                self.counts['flushes'] += 1
+                if result.errors:
+                    self.last_error = result.errors[-1][1]
+            if result.failed:
+                logger.error('write behind of %d of %d objects of %s '
+                             'failed: %s', result.failed, len(batch),
+                             self.model.__name__, result.errors)
+            return result
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['pending'] = len(self.pending)
+            return stats
+
+write_behind_buffers = {}
+write_behind_lock = threading.Lock()
+
+@atexit.register
+def flush_write_behind():
+    """ Flush the write behind buffers of all models
+    """
+    for buf in write_behind_buffers.values():
+        buf.flush()
+
 class SequenceModel(Model):
     seq = IntegerField()
+
     @classmethod
-    def get_next(cls, key):
+    def reserve(cls, key, count):
+        """ Reserve count sequential values, return the first one
+        """
         col = cls.collection()
         v = col.find_and_modify(query={'_id': key},
-                                update={'$inc': {'seq': 1}},
+                                update={'$inc': {'seq': count}},
                                 upsert=True, new=True)
-        if v:
-            return v['seq']
-        return v
+        return v['seq'] - count + 1
+
+    @classmethod
+    def get_next(cls, key):
+        return sequence_allocator.next(key)
@@ -0,0 +1,420 @@
+# Benchmarks of mongopie
+# Start mongod and run
+#   % python mongopie_bench.py
+# or run against an in-process mongomock
+#   % python mongopie_bench.py --mock
+# Write the results as json to track regressions between releases
+#   % python mongopie_bench.py --json results.json
+# Run some of the benchmarks
+#   % python mongopie_bench.py hydration save
+
+import sys
+import time
+import json
+import platform
+import threading
+import optparse
+import pymongo
+import mongopie
+from bson import BSON
+from bson.objectid import ObjectId
+
+mongopie.set_defaultdb('localhost', 27017, 'piebench')
+
+class Article(mongopie.Model):
+    title = mongopie.StringField()
+    score = mongopie.IntegerField()
+
+class CompactArticle(mongopie.Model):
+    use_slots = True
+    title = mongopie.StringField()
+    score = mongopie.IntegerField()
+
+class LazyArticle(mongopie.Model):
+    lazy_bson = True
+    title = mongopie.StringField()
+    score = mongopie.IntegerField()
+
+class Comment(mongopie.Model):
+    author = mongopie.StringField()
+    votes = mongopie.IntegerField()
+
+class Thread(mongopie.Model):
+    comments = mongopie.ChildrenField(Comment)
+
+class Author(mongopie.Model):
+    name = mongopie.StringField()
+
+class Post(mongopie.Model):
+    title = mongopie.StringField()
+    author = mongopie.ReferenceField(Author)
+
+class Ticket(mongopie.Model):
+    number = mongopie.SequenceField('bench_ticket')
+
+class BlockTicket(mongopie.Model):
+    number = mongopie.SequenceField('bench_block_ticket', block_size=100)
+
+# Records of all benchmarks run, see record
+results = []
+
+def record(bench, **values):
+    values['bench'] = bench
+    results.append(values)
+
+def scaled(n):
+    return max(1, int(n * options.scale))
+
+def setup_articles(total):
+    Article.remove()
+    for i in xrange(total):
+        Article.collection().insert({'title': 'article %d' % i,
+                                     'score': i % 100})
+
+def timeit(func, repeat=5):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_pagination(total=100000, count=20,
+                     depths=(1, 10, 100, 1000, 5000)):
+    """ Fetch one page at increasing depths with paginate (skip) and
+    seek (keyset)
+    """
+    setup_articles(total)
+    qs = Article.find().sort('-score')
+    tokens = {}
+    token = None
+    for page in xrange(1, max(depths) + 1):
+        if page in depths:
+            tokens[page] = token
+        token = qs.seek(token, count=count).next_token
+        if token is None:
+            break
+
+    print '%8s %12s %12s' % ('page', 'paginate ms', 'seek ms')
+    for depth in depths:
+        if depth not in tokens:
+            break
+        t1 = timeit(lambda: list(qs.paginate(page=depth, count=count)))
+        t2 = timeit(lambda: list(qs.seek(tokens[depth], count=count)))
+        print '%8d %12.2f %12.2f' % (depth, t1 * 1000, t2 * 1000)
+        record('pagination', page=depth, paginate_ms=t1 * 1000,
+               seek_ms=t2 * 1000)
+
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    # Reading __dict__ of a slots object creates an empty one
+    d = getattr(obj, '__dict__', None)
+    if d:
+        size += sys.getsizeof(d)
+    return size
+
+def bench_hydration(total=100000):
+    """ Make objects of documents through the setattr path of
+    Model.__init__ and the loaders of get_from_data
+    """
+    docs = [{u'_id': ObjectId(), u'title': u'article %d' % i,
+             u'score': i % 100}
+            for i in xrange(total)]
+
+    def by_init():
+        for d in docs:
+            obj = Article(**mongopie.force_string_keys(d))
+            obj.clear_dirty()
+
+    def by_loader(cls):
+        return lambda: [cls.get_from_data(d) for d in docs]
+
+    print '%16s %12s %12s' % ('path', 'objs/sec', 'bytes/obj')
+    for name, func, cls in [
+        ('setattr', by_init, Article),
+        ('loader', by_loader(Article), Article),
+        ('loader+slots', by_loader(CompactArticle), CompactArticle)]:
+        elapsed = timeit(func)
+        size = object_size(cls.get_from_data(docs[0]))
+        print '%16s %12d %12d' % (name, total / elapsed, size)
+        record('hydration', path=name, objs_per_sec=total / elapsed,
+               bytes_per_obj=size)
+
+    if mongopie.RawBSONDocument is None:
+        return
+    # Read one field of raw documents, decoded in full or lazily
+    raw_docs = [mongopie.RawBSONDocument(BSON.encode(d)) for d in docs]
+    def decoded():
+        for r in raw_docs:
+            Article.get_from_data(mongopie.decode_bson(r.raw)).title
+    def lazy():
+        for r in raw_docs:
+            LazyArticle.get_from_data(r).title
+    for name, func in [('decode+1 field', decoded),
+                       ('lazy+1 field', lazy)]:
+        elapsed = timeit(func)
+        print '%16s %12d %12s' % (name, total / elapsed, '')
+        record('hydration', path=name, objs_per_sec=total / elapsed)
+
+def bench_children(total=100, loops=100):
+    """ Walk the children of an object in a nested loop, building
+    the children on every access versus the cached children
+    """
+    doc = {u'_id': ObjectId(),
+           u'comments': [{u'author': u'user %d' % i, u'votes': i}
+                         for i in xrange(total)]}
+    field = Thread.field_map['comments']
+    created = [0]
+    loader = Comment.loader
+    def counting_loader(datadict):
+        created[0] += 1
+        return loader(datadict)
+
+    def uncached():
+        thread = Thread.get_from_data(doc)
+        for _ in xrange(loops):
+            for c in [Comment.loader(v) for v in field.get_raw(thread)]:
+                c.votes
+
+    def cached():
+        thread = Thread.get_from_data(doc)
+        for _ in xrange(loops):
+            for c in thread.comments:
+                c.votes
+
+    print '%16s %12s %12s' % ('children', 'ms', 'objects')
+    Comment.loader = staticmethod(counting_loader)
+    try:
+        for name, func in [('uncached', uncached), ('cached', cached)]:
+            created[0] = 0
+            func()
+            count = created[0]
+            elapsed = timeit(func)
+            print '%16s %12.2f %12d' % (name, elapsed * 1000, count)
+            record('children', path=name, ms=elapsed * 1000,
+                   objects=count)
+    finally:
+        Comment.loader = staticmethod(loader)
+
+def bench_save(total=10000):
+    """ Save new objects one by one and in bulk, and update one
+    field of existing objects
+    """
+    def save_new():
+        Article.remove()
+        for i in xrange(total):
+            Article(title='article %d' % i, score=i % 100).save()
+
+    def bulk_new():
+        Article.remove()
+        Article.bulk_create([Article(title='article %d' % i,
+                                     score=i % 100)
+                             for i in xrange(total)])
+
+    def save_existing():
+        for obj in objs:
+            obj.score += 1
+            obj.save()
+
+    def save_unchanged():
+        for obj in objs:
+            obj.save()
+
+    print '%16s %12s' % ('save', 'objs/sec')
+    for name, func in [('new', save_new), ('bulk_create', bulk_new)]:
+        elapsed = timeit(func, repeat=3)
+        print '%16s %12d' % (name, total / elapsed)
+        record('save', path=name, objs_per_sec=total / elapsed)
+
+    objs = list(Article.find())
+    for name, func in [('existing', save_existing),
+                       ('unchanged', save_unchanged)]:
+        elapsed = timeit(func, repeat=3)
+        print '%16s %12d' % (name, total / elapsed)
+        record('save', path=name, objs_per_sec=total / elapsed)
+
+def bench_multi_get(total=10000, batch_sizes=(1, 10, 100, 1000)):
+    """ Get objects by ids in batches with a cold and a warm object
+    cache
+    """
+    setup_articles(total)
+    ids = [d['_id'] for d in Article.collection().find({}, ['_id'])]
+
+    def multi_get(batch_size, cold):
+        def run():
+            for batch in mongopie.iter_chunks(ids, batch_size):
+                if cold:
+                    Article.invalidate_cache()
+                list(Article.multi_get(batch))
+        return run
+
+    print '%16s %12s %12s' % ('batch', 'cold objs/s', 'warm objs/s')
+    for batch_size in batch_sizes:
+        cold = timeit(multi_get(batch_size, True), repeat=3)
+        warm = timeit(multi_get(batch_size, False), repeat=3)
+        print '%16d %12d %12d' % (batch_size, total / cold, total / warm)
+        record('multi_get', batch_size=batch_size,
+               cold_objs_per_sec=total / cold,
+               warm_objs_per_sec=total / warm)
+
+def bench_cache(total=10000, loops=10):
+    """ Model.get through a hit of the object cache, a miss, and the
+    lru and lfu policies at a cache smaller than the working set
+    """
+    setup_articles(total)
+    ids = [d['_id'] for d in Article.collection().find({}, ['_id'])]
+    cache = Article.obj_cache
+
+    def get_all():
+        for _ in xrange(loops):
+            for objid in ids:
+                Article.get(objid)
+
+    def get_missed():
+        for objid in ids:
+            Article.invalidate_cache([objid])
+            Article.get(objid)
+
+    print '%16s %12s %12s' % ('cache', 'gets/sec', 'hit ratio')
+    try:
+        for name, func, count, cache_options in [
+            ('hit', get_all, total * loops, {'max_size': total}),
+            ('miss', get_missed, total, {'max_size': total}),
+            ('lru/2', get_all, total * loops,
+             {'policy': 'lru', 'max_size': total / 2}),
+            ('lfu/2', get_all, total * loops,
+             {'policy': 'lfu', 'max_size': total / 2})]:
+            Article.obj_cache = mongopie.make_obj_cache(**cache_options)
+            if func is get_all:
+                for objid in ids:
+                    Article.get(objid)
+            Article.obj_cache.reset_stats()
+            elapsed = timeit(func, repeat=3)
+            stats = Article.obj_cache.stats()
+            lookups = stats['hits'] + stats['misses']
+            ratio = lookups and float(stats['hits']) / lookups
+            print '%16s %12d %12.2f' % (name, count / elapsed, ratio)
+            record('cache', path=name, gets_per_sec=count / elapsed,
+                   hit_ratio=ratio)
+    finally:
+        Article.obj_cache = cache
+
+def bench_references(total=1000, authors=50):
+    """ Access the ReferenceField of posts one by one and with
+    prefetch
+    """
+    Author.remove()
+    Post.remove()
+    author_ids = [Author.collection().insert({'name': 'author %d' % i})
+                  for i in xrange(authors)]
+    author_key = Post.field_map['author'].get_key()
+    for i in xrange(total):
+        Post.collection().insert({'title': 'post %d' % i,
+                                  author_key: author_ids[i % authors]})
+
+    def naive():
+        Author.invalidate_cache()
+        for post in Post.find().iterator():
+            post.author.name
+
+    def prefetched():
+        Author.invalidate_cache()
+        for post in Post.find().prefetch('author').iterator():
+            post.author.name
+
+    def cached():
+        for post in Post.find().iterator():
+            post.author.name
+
+    print '%16s %12s' % ('reference', 'posts/sec')
+    for name, func in [('naive', naive), ('prefetch', prefetched),
+                       ('cached', cached)]:
+        elapsed = timeit(func, repeat=3)
+        print '%16s %12d' % (name, total / elapsed)
+        record('references', path=name, posts_per_sec=total / elapsed)
+
+def bench_sequences(total=2000, thread_counts=(1, 4, 8)):
+    """ Draw sequence values from threads with a round trip per
+    value and with blocks of 100 values
+    """
+    def draw(cls, threads):
+        def run():
+            def work():
+                for _ in xrange(total / threads):
+                    cls().fill_auto_fields(True)
+            workers = [threading.Thread(target=work)
+                       for _ in xrange(threads)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        return run
+
+    print '%16s %12s %12s' % ('threads', 'single/s', 'block/s')
+    for threads in thread_counts:
+        single = timeit(draw(Ticket, threads), repeat=3)
+        block = timeit(draw(BlockTicket, threads), repeat=3)
+        print '%16d %12d %12d' % (threads, total / single, total / block)
+        record('sequences', threads=threads,
+               single_per_sec=total / single,
+               block_per_sec=total / block)
+
+benchmarks = [
+    ('hydration', bench_hydration, {'total': 100000}),
+    ('children', bench_children, {}),
+    ('save', bench_save, {'total': 10000}),
+    ('multi_get', bench_multi_get, {'total': 10000}),
+    ('pagination', bench_pagination, {'total': 100000}),
+    ('cache', bench_cache, {'total': 10000}),
+    ('references', bench_references, {'total': 1000}),
+    ('sequences', bench_sequences, {'total': 2000}),
+    ]
+
+def use_mock():
+    """ Run against an in-process mongomock instead of mongod
+    """
+    import mongomock
+    mongopie.MongoClient = mongomock.MongoClient
+    mongopie.reset_connections()
+
+parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+parser.add_option('--mock', action='store_true', default=False,
+                  help='run against mongomock instead of mongod')
+parser.add_option('--json', dest='json', default=None,
+                  help='write the results as json to the file')
+parser.add_option('--scale', type='float', default=1.0,
+                  help='scale the number of documents, e.g. 0.1')
+options = optparse.Values(parser.defaults)
+
+def main(argv):
+    global options
+    options, names = parser.parse_args(argv)
+    known = [name for name, _, _ in benchmarks]
+    for name in names:
+        if name not in known:
+            parser.error('unknown benchmark %s, choose from %s' %
+                         (name, ', '.join(known)))
+    if options.mock:
+        use_mock()
+
+    for name, func, kwargs in benchmarks:
+        if names and name not in names:
+            continue
+        print '== %s' % name
+        kwargs = dict((k, scaled(v)) for k, v in kwargs.iteritems())
+        func(**kwargs)
+
+    if options.json:
+        data = {'meta': {'python': platform.python_version(),
+                         'pymongo': pymongo.version,
+                         'mock': options.mock,
+                         'scale': options.scale,
+                         'time': time.time()},
+                'results': results}
+        with open(options.json, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
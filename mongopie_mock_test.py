@@ -0,0 +1,962 @@
+# Unit tests of mongopie against mongomock, an in-process stand-in
+# of mongod
+#
+# % pip install mongomock
+# % python -m unittest mongopie_mock_test
+
+import logging
+import pickle
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from bson import BSON
+from pymongo.errors import BulkWriteError
+import mongopie
+
+DB_NAME = 'pietest_mock'
+
+_saved = {}
+
+# Resumed cursors are logged as warnings
+logging.getLogger('mongopie').addHandler(logging.NullHandler())
+
+def setUpModule():
+    if mongomock is None:
+        return
+    _saved['MongoClient'] = mongopie.MongoClient
+    _saved['default_db'] = mongopie.default_db
+    mongopie.MongoClient = mongomock.MongoClient
+    mongopie.reset_connections()
+    mongopie.set_defaultdb('localhost', 27017, DB_NAME)
+
+def tearDownModule():
+    if not _saved:
+        return
+    mongopie.MongoClient = _saved['MongoClient']
+    mongopie.default_db = _saved['default_db']
+    mongopie.reset_connections()
+
+class Article(mongopie.Model):
+    title = mongopie.StringField()
+    body = mongopie.StringField()
+    views = mongopie.IntegerField()
+    tags = mongopie.ArrayField()
+    meta = mongopie.DictField()
+
+class Vote(mongopie.Model):
+    voter = mongopie.StringField()
+    created_at = mongopie.DateTimeField(auto_now=True)
+
+class Comment(mongopie.Model):
+    author = mongopie.StringField()
+    text = mongopie.StringField()
+
+class Post(mongopie.Model):
+    title = mongopie.StringField()
+    comments = mongopie.ChildrenField(Comment)
+
+@unittest.skipIf(mongomock is None, 'mongomock is required')
+class MockTestCase(unittest.TestCase):
+    def setUp(self):
+        mongopie.get_client('localhost', 27017).drop_database(DB_NAME)
+        mongopie.clear_obj_cache()
+
+    def raw(self, model, objid):
+        return model.collection().find_one({'_id': objid})
+
+class ConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.options = dict(mongopie.connection_options)
+
+    def tearDown(self):
+        mongopie.connection_options.clear()
+        mongopie.connection_options.update(self.options)
+
+    def test_client_options(self):
+        options = mongopie.client_options(2)
+        self.assertEqual(options['max_pool_size'], 100)
+        self.assertFalse('maxPoolSize' in options)
+        self.assertFalse('socketTimeoutMS' in options)
+        options = mongopie.client_options(3)
+        self.assertEqual(options['maxPoolSize'], 100)
+        self.assertFalse('max_pool_size' in options)
+        self.assertEqual(options['connectTimeoutMS'], 20000)
+
+    def test_renamed_option(self):
+        del mongopie.connection_options['max_pool_size']
+        mongopie.connection_options['maxPoolSize'] = 10
+        self.assertEqual(mongopie.client_options(2)['max_pool_size'], 10)
+        self.assertEqual(mongopie.client_options(3)['maxPoolSize'], 10)
+
+class SaveTest(MockTestCase):
+    def test_insert(self):
+        a = Article(title='t', views=3)
+        a.save()
+        self.assertTrue(a.id is not None)
+        doc = self.raw(Article, a.id)
+        self.assertEqual(doc['title'], 't')
+        self.assertEqual(doc['views'], 3)
+
+    def test_save_sets_changed_fields(self):
+        a = Article(title='t', body='b')
+        a.save()
+        # A concurrent writer changes another field
+        Article.collection().update({'_id': a.id},
+                                    {'$set': {'body': 'other'}})
+        a.title = 't2'
+        self.assertEqual(a.get_update_dict(), {'$set': {'title': u't2'}})
+        a.save()
+        doc = self.raw(Article, a.id)
+        self.assertEqual(doc['title'], 't2')
+        self.assertEqual(doc['body'], 'other')
+
+    def test_save_unchanged(self):
+        a = Article(title='t')
+        a.save()
+        self.assertEqual(a.get_update_dict(), {})
+        a.save()
+        self.assertEqual(self.raw(Article, a.id)['title'], 't')
+
+    def test_tracked_array(self):
+        a = Article(title='t', tags=['x'])
+        a.save()
+        a = Article.get(a.id)
+        a.tags.append('y')
+        a.save()
+        self.assertEqual(self.raw(Article, a.id)['tags'], ['x', 'y'])
+
+    def test_save_deleted_document(self):
+        a = Article(title='t', body='b', views=2)
+        a.save()
+        Article.collection().remove({'_id': a.id})
+        a.title = 't2'
+        a.save()
+        doc = self.raw(Article, a.id)
+        self.assertEqual((doc['title'], doc['body'], doc['views']),
+                         ('t2', 'b', 2))
+
+    def test_save_preset_id(self):
+        objid = mongopie.ObjectId()
+        a = Article(id=objid, title='t', body='b')
+        a.save()
+        self.assertEqual(self.raw(Article, objid)['body'], 'b')
+
+    def test_bulk_save_deleted_document(self):
+        a = Article(title='t', body='b')
+        b = Article(title='u', body='c')
+        Article.bulk_save([a, b])
+        Article.collection().remove({'_id': a.id})
+        a.title = 't2'
+        b.title = 'u2'
+        result = Article.bulk_save([a, b])
+        self.assertEqual((result.updated, result.upserted), (1, 1))
+        self.assertEqual(self.raw(Article, a.id)['body'], 'b')
+        self.assertEqual(self.raw(Article, b.id)['title'], 'u2')
+
+    def test_pickle_tracked(self):
+        a = Article(title='t', tags=['x'], meta={'k': 1})
+        a.save()
+        a = Article.get(a.id)
+        a.tags.append('y')
+        a.meta['k'] = 2
+        for protocol in (0, 2):
+            b = pickle.loads(pickle.dumps(a, protocol))
+            self.assertEqual(b.tags, ['x', 'y'])
+            self.assertEqual(b.meta, {'k': 2})
+            # Tracked again on the unpickled object
+            b.clear_dirty()
+            b.tags.append('z')
+            self.assertEqual(b.get_update_dict(),
+                             {'$set': {'tags': ['x', 'y', 'z']}})
+
+    def test_bulk_save_error_resets_ids(self):
+        Article(title='old', body='b').save()
+        old = Article.find().defer('body')[0]
+        old._dirty_keys.add('body')
+        new = Article(title='new')
+        self.assertRaises(mongopie.PartialObjectError,
+                          Article.bulk_save, [new, old])
+        self.assertEqual(new.id, None)
+        new.save()
+        self.assertEqual(self.raw(Article, new.id)['title'], 'new')
+
+    def test_multi_get_cache(self):
+        a = Article(title='a')
+        a.save()
+        b = Article(title='b')
+        b.save()
+        Article.get(a.id)
+        # Cached objects are not read again
+        Article.collection().update({'_id': a.id},
+                                    {'$set': {'title': 'changed'}})
+        objs = list(Article.multi_get([b.id, a.id]))
+        self.assertEqual([obj.title for obj in objs], ['b', 'a'])
+        self.assertTrue(b.id in Article.obj_cache)
+
+class QueryTest(MockTestCase):
+    def test_nonzero_slice(self):
+        for i in xrange(3):
+            Article(title='t%d' % i).save()
+        qs = Article.find()[100:120]
+        self.assertEqual(qs.count(), 3)
+        self.assertFalse(qs)
+        qs = Article.find()[1:2]
+        qs.count()
+        self.assertTrue(qs)
+        qs = Article.find().limit(1)
+        self.assertEqual(len(qs), 1)
+        self.assertTrue(qs)
+        self.assertFalse(Article.find(title='x'))
+
+class Attachment(mongopie.Model):
+    name = mongopie.StringField()
+    data = mongopie.FileField()
+
+class UpdateTest(MockTestCase):
+    def make_articles(self):
+        arts = [Article(title='a%d' % i, views=i % 2) for i in xrange(4)]
+        for a in arts:
+            a.save()
+        return arts
+
+    def test_make_update_coerce(self):
+        update = Article.make_update(set={'views': '5'}, inc={'views': 1.0},
+                                     unset=['body'])
+        self.assertEqual(update['$set'], {'views': 5})
+        self.assertTrue(isinstance(update['$inc']['views'], long))
+        self.assertEqual(update['$unset'], {'body': ''})
+
+    def test_make_update_push_each(self):
+        update = Article.make_update(push={'tags': ['x', 'y']},
+                                     add_to_set={'tags': 'z'})
+        self.assertEqual(update['$push'], {'tags': {'$each': ['x', 'y']}})
+        self.assertEqual(update['$addToSet'], {'tags': 'z'})
+
+    def test_update_counts(self):
+        arts = self.make_articles()
+        ret = Article.find(views=1).update(push={'tags': ['x', 'y']})
+        self.assertEqual(ret.matched, 2)
+        self.assertEqual(ret.modified, 2)
+        self.assertEqual(ret.upserted_id, None)
+        self.assertEqual(self.raw(Article, arts[1].id)['tags'], ['x', 'y'])
+        self.assertEqual(self.raw(Article, arts[0].id).get('tags'), [])
+
+        ret = Article.find(title='new').update(set={'views': '7'},
+                                               upsert=True)
+        self.assertEqual(ret.matched, 0)
+        self.assertTrue(ret.upserted_id is not None)
+        self.assertEqual(self.raw(Article, ret.upserted_id)['views'], 7)
+
+    def test_update_evicts_ids(self):
+        arts = self.make_articles()
+        for a in arts:
+            Article.obj_cache.set(a.id, a)
+        Article.find(views=1).update(inc={'views': 1})
+        self.assertFalse(arts[1].id in Article.obj_cache)
+        self.assertFalse(arts[3].id in Article.obj_cache)
+        self.assertTrue(arts[0].id in Article.obj_cache)
+        self.assertEqual(Article.get(arts[1].id).views, 2)
+
+    def test_update_evicts_class(self):
+        arts = self.make_articles()
+        for a in arts:
+            Article.obj_cache.set(a.id, a)
+        max_size = Article.obj_cache.max_size
+        # More matches than the cache can hold
+        Article.obj_cache.max_size = 1
+        try:
+            Article.find(views=1).update(inc={'views': 1})
+        finally:
+            Article.obj_cache.max_size = max_size
+        self.assertEqual(len(Article.obj_cache), 0)
+
+class PartialLoadTest(MockTestCase):
+    def setUp(self):
+        super(PartialLoadTest, self).setUp()
+        a = Article(title='t', body='b', views=1)
+        a.save()
+        self.objid = a.id
+
+    def test_save_loaded_field(self):
+        a = Article.find().only('title')[0]
+        a.title = 't2'
+        a.save()
+        doc = self.raw(Article, self.objid)
+        self.assertEqual(doc['title'], 't2')
+        self.assertEqual(doc['body'], 'b')
+
+    def test_save_assigned_deferred_field(self):
+        a = Article.find().only('title')[0]
+        a.body = 'b2'
+        a.save()
+        doc = self.raw(Article, self.objid)
+        self.assertEqual(doc['body'], 'b2')
+        self.assertEqual(doc['views'], 1)
+
+    def test_save_auto_now(self):
+        v = Vote(voter='tom')
+        v.save()
+        v = Vote.find().only('voter')[0]
+        v.voter = 'jerry'
+        v.save()
+        doc = self.raw(Vote, v.id)
+        self.assertEqual(doc['voter'], 'jerry')
+        self.assertTrue(doc['created_at'] is not None)
+
+    def test_deferred_field_loads(self):
+        a = Article.find().defer('body')[0]
+        self.assertTrue(a.is_partial())
+        self.assertEqual(a.body, 'b')
+        self.assertFalse(a.is_partial())
+
+    def test_unloaded_field_refused(self):
+        a = Article.find().defer('body')[0]
+        a._dirty_keys.add('body')
+        self.assertRaises(mongopie.PartialObjectError, a.save)
+
+    def test_deferred_file_field(self):
+        old_file = mongopie.ObjectId()
+        Attachment(name='a', data=old_file).save()
+        a = Attachment.find().defer('data')[0]
+        self.assertEqual(Attachment.field_map['data'].get_raw(a), old_file)
+        self.assertFalse(a.is_partial())
+        self.assertEqual(a.get_update_dict(), {})
+
+    def test_replace_deferred_file(self):
+        old_file = mongopie.ObjectId()
+        new_file = mongopie.ObjectId()
+        Attachment(name='a', data=old_file).save()
+        a = Attachment.find().defer('data')[0]
+        a.data = new_file
+        # The replaced file is deleted after saving
+        self.assertEqual(a._file_deletes, [old_file])
+        self.assertEqual(a.get_update_dict(), {'$set': {'_data': new_file}})
+
+class MemoryFile(StringIO):
+    def __init__(self, fs, _id=None, **kwargs):
+        StringIO.__init__(self, fs.files.get(_id, ''))
+        self.fs = fs
+        self._id = _id or mongopie.ObjectId()
+        self.length = len(self.getvalue())
+
+    def close(self):
+        self.fs.files[self._id] = self.getvalue()
+        self.length = len(self.fs.files[self._id])
+
+class MemoryGridFS(object):
+    """ GridFS of pymongo 2 does not run on mongomock
+    """
+    files = {}
+
+    def __init__(self, database):
+        pass
+
+    def new_file(self, **kwargs):
+        return MemoryFile(self)
+
+    def get(self, objid):
+        return MemoryFile(self, objid)
+
+    def delete(self, objid):
+        self.files.pop(objid, None)
+
+class ChildrenTest(MockTestCase):
+    def make_post(self):
+        p = Post(title='t', comments=[Comment(author='a', text='one'),
+                                      Comment(author='b', text='two')])
+        p.save()
+        return Post.get(p.id)
+
+    def stored_texts(self, p):
+        return [c['text'] for c in self.raw(Post, p.id)['comments']]
+
+    def test_edit_child(self):
+        p = self.make_post()
+        p.comments[1].text = 'TWO'
+        update = p.get_update_dict()
+        self.assertEqual(update.keys(), ['$set'])
+        self.assertEqual(update['$set'].keys(), ['comments.1'])
+        self.assertEqual(update['$set']['comments.1']['text'], 'TWO')
+        p.save()
+        self.assertEqual(self.stored_texts(p), ['one', 'TWO'])
+
+    def test_append_child(self):
+        p = self.make_post()
+        p.comments.append(Comment(author='c', text='three'))
+        update = p.get_update_dict()
+        self.assertEqual(update.keys(), ['$push'])
+        docs = update['$push']['comments']['$each']
+        self.assertEqual([d['text'] for d in docs], ['three'])
+        p.save()
+        self.assertEqual(self.stored_texts(p), ['one', 'two', 'three'])
+
+    def test_remove_child(self):
+        p = self.make_post()
+        del p.comments[0]
+        update = p.get_update_dict()
+        self.assertEqual(update.keys(), ['$set'])
+        self.assertEqual([d['text'] for d in update['$set']['comments']],
+                         ['two'])
+        p.save()
+        self.assertEqual(self.stored_texts(p), ['two'])
+
+    def test_append_and_edit(self):
+        p = self.make_post()
+        p.comments[0].text = 'ONE'
+        p.comments.append(Comment(author='c', text='three'))
+        update = p.get_update_dict()
+        # $set and $push of the same array conflict, it is rewritten
+        self.assertEqual(update.keys(), ['$set'])
+        self.assertEqual([d['text'] for d in update['$set']['comments']],
+                         ['ONE', 'two', 'three'])
+        p.save()
+        self.assertEqual(self.stored_texts(p), ['ONE', 'two', 'three'])
+        self.assertEqual(Post.get(p.id).get_update_dict(), {})
+
+class FileTest(MockTestCase):
+    def setUp(self):
+        super(FileTest, self).setUp()
+        self.grid_fs = mongopie.GridFS
+        mongopie.GridFS = MemoryGridFS
+        MemoryGridFS.files.clear()
+        mongopie.reset_connections()
+
+    def tearDown(self):
+        mongopie.GridFS = self.grid_fs
+        mongopie.reset_connections()
+
+    def test_handle_per_thread(self):
+        a = Attachment(data='0123456789')
+        a.save()
+        f = a.data
+        self.assertTrue(a.data is f)
+        handles = []
+        t = threading.Thread(target=lambda: handles.append(a.data))
+        t.start()
+        t.join()
+        self.assertFalse(handles[0] is f)
+        self.assertEqual(handles[0].read(), '0123456789')
+
+    def test_iter_range_own_handle(self):
+        a = Attachment(data='0123456789')
+        a.save()
+        f = a.data
+        f.read(3)
+        field = Attachment.field_map['data']
+        self.assertEqual(''.join(field.iter_range(a, 2, 5)), '234')
+        self.assertEqual(f.tell(), 3)
+
+    def test_bulk_create_deletes_replaced(self):
+        a = Attachment(data='one')
+        old_file = Attachment.field_map['data'].get_raw(a)
+        a.data = 'two'
+        Attachment.bulk_create([a])
+        self.assertFalse(old_file in MemoryGridFS.files)
+        self.assertEqual(a.data.read(), 'two')
+
+class Event(mongopie.Model):
+    rank = mongopie.IntegerField(default=None)
+
+class SeekTest(MockTestCase):
+    def setUp(self):
+        super(SeekTest, self).setUp()
+        # Two events lack the sort key
+        for rank in (3, None, 1, 2, None, 2):
+            event = Event()
+            if rank is not None:
+                event.rank = rank
+            event.save()
+
+    def walk(self, qs, count):
+        pages = []
+        token = None
+        while True:
+            page = qs.seek(token, count=count)
+            pages.append(page)
+            token = page.next_token
+            if not token:
+                return pages
+
+    def check_nullable(self, qs):
+        expect = [event.id for event in qs]
+        for count in (1, 2, 4):
+            pages = self.walk(qs, count)
+            self.assertEqual([event.id for page in pages for event in page],
+                             expect)
+            for i in xrange(1, len(pages)):
+                back = qs.seek(pages[i].prev_token, count=count)
+                self.assertEqual([event.id for event in back],
+                                 [event.id for event in pages[i - 1]])
+
+    def test_nullable_ascending(self):
+        self.check_nullable(Event.find().sort('rank'))
+
+    def test_nullable_descending(self):
+        self.check_nullable(Event.find().sort('-rank'))
+
+class ResumableTest(MockTestCase):
+    def setUp(self):
+        super(ResumableTest, self).setUp()
+        for rank in xrange(30):
+            Event(rank=rank % 7).save()
+        self.get_cursor = mongopie.CursorWrapper.get_cursor
+
+    def tearDown(self):
+        mongopie.CursorWrapper.get_cursor = self.get_cursor
+
+    def fail_after(self, n):
+        # Every cursor raises after n documents
+        get_cursor = self.get_cursor
+        def flaky_cursor(wrapper, *args, **kwargs):
+            cursor = get_cursor(wrapper, *args, **kwargs)
+            def iter_flaky():
+                for i, datadict in enumerate(cursor):
+                    if i == n:
+                        raise mongopie.AutoReconnect('lost')
+                    yield datadict
+            return iter_flaky()
+        mongopie.CursorWrapper.get_cursor = flaky_cursor
+
+    def check_resumable(self, qs):
+        expect = [event.id for event in qs]
+        self.assertEqual([event.id for event in qs.resumable()], expect)
+        self.fail_after(3)
+        self.assertEqual([event.id for event in qs.resumable(retries=1)],
+                         expect)
+        mongopie.CursorWrapper.get_cursor = self.get_cursor
+
+    def test_resume(self):
+        self.check_resumable(Event.find().sort('rank'))
+
+    def test_limit(self):
+        qs = Event.find().sort('rank').limit(5)
+        self.assertEqual(len(list(qs.resumable())), 5)
+        self.check_resumable(qs)
+
+    def test_slice(self):
+        self.check_resumable(Event.find().sort('-rank')[4:15])
+        self.check_resumable(Event.find().sort('rank')[4:15].limit(8))
+        self.check_resumable(Event.find().sort('rank')[25:])
+
+    def test_retries_exhausted(self):
+        self.fail_after(0)
+        qs = Event.find().resumable(retries=1)
+        self.assertRaises(mongopie.AutoReconnect, list, qs)
+
+class LazyArticle(mongopie.Model):
+    lazy_bson = True
+    title = mongopie.StringField()
+    views = mongopie.IntegerField()
+
+class RawDocument(object):
+    # A document read with raw codec options
+    def __init__(self, doc):
+        self.raw = BSON.encode(doc)
+
+class ExportTest(MockTestCase):
+    def make_articles(self):
+        for i in xrange(3):
+            Article(title='a%d' % i, views=i, tags=['t%d' % i],
+                    meta={'n': i}).save()
+        return self.dump(Article.collection())
+
+    def dump(self, col):
+        return sorted(col.find(), key=lambda d: d['_id'])
+
+    def round_trip(self, format, compress=False):
+        docs = self.make_articles()
+        stream = StringIO()
+        self.assertEqual(Article.export(stream, format=format,
+                                        compress=compress), 3)
+        Article.collection().remove({})
+        result = Article.import_(StringIO(stream.getvalue()),
+                                 format=format, batch_size=2)
+        self.assertEqual(result.inserted, 3)
+        self.assertEqual(result.batches, 2)
+        self.assertEqual(self.dump(Article.collection()), docs)
+        return stream.getvalue()
+
+    def test_bson(self):
+        data = self.round_trip('bson')
+        docs = list(mongopie.read_export_stream(StringIO(data), 'bson'))
+        self.assertEqual([d['title'] for d in docs], ['a0', 'a1', 'a2'])
+
+    def test_jsonl(self):
+        data = self.round_trip('jsonl')
+        self.assertEqual(len(data.splitlines()), 3)
+
+    def test_gzip(self):
+        data = self.round_trip('bson', compress=True)
+        self.assertEqual(data[:2], '\x1f\x8b')
+
+    def test_truncated_bson(self):
+        self.make_articles()
+        stream = StringIO()
+        Article.export(stream)
+        Article.collection().remove({})
+        self.assertRaises(ValueError, Article.import_,
+                          StringIO(stream.getvalue()[:-3]))
+
+    def test_files_stream(self):
+        db = mongopie.get_database(mongopie.default_db)
+        fid = mongopie.ObjectId()
+        db['fs.files'].insert({'_id': fid, 'length': 6, 'chunkSize': 4})
+        db['fs.chunks'].insert({'files_id': fid, 'n': 1, 'data': 'ef'})
+        db['fs.chunks'].insert({'files_id': fid, 'n': 0, 'data': 'abcd'})
+        Attachment.collection().insert({'name': 'x', '_data': fid})
+        Attachment.collection().insert({'name': 'y', '_data': fid})
+        files = [self.dump(db['fs.files']), self.dump(db['fs.chunks'])]
+        docs = self.dump(Attachment.collection())
+
+        stream, files_stream = StringIO(), StringIO()
+        Attachment.export(stream, format='jsonl', compress=True,
+                          files_stream=files_stream)
+        records = list(mongopie.read_export_stream(
+                mongopie.gzip.GzipFile(
+                    fileobj=StringIO(files_stream.getvalue())), 'jsonl'))
+        # Shared files are written once, chunks in order
+        self.assertEqual([(r['c'], r['d'].get('n')) for r in records],
+                         [('files', None), ('chunks', 0), ('chunks', 1)])
+
+        mongopie.get_client('localhost', 27017).drop_database(DB_NAME)
+        Attachment.import_(StringIO(stream.getvalue()), format='jsonl',
+                           files_stream=StringIO(files_stream.getvalue()))
+        self.assertEqual(self.dump(Attachment.collection()), docs)
+        self.assertEqual([self.dump(db['fs.files']),
+                          self.dump(db['fs.chunks'])], files)
+
+class LazyBsonTest(unittest.TestCase):
+    def load(self, **doc):
+        doc['_id'] = mongopie.ObjectId()
+        return LazyArticle.get_from_data(RawDocument(doc))
+
+    def test_decode_on_access(self):
+        a = self.load(title=u't', views=3)
+        self.assertEqual(a._lazy.get('title'), u't')
+        self.assertEqual(a.title, u't')
+        self.assertEqual(a.views, 3)
+        self.assertEqual(sorted(a._lazy.offsets), [])
+
+    def test_concurrent_reader(self):
+        a = self.load(title=u't')
+        class RacingDocument(mongopie.LazyDocument):
+            def get(self, key, default=None):
+                # Another thread decodes the field meanwhile
+                getter = super(RacingDocument, self).get
+                setattr(a, '_' + key, getter(key))
+                self.discard(key)
+                return getter(key, default)
+        a._lazy = RacingDocument(a._lazy.raw)
+        self.assertEqual(a.title, u't')
+
+    def test_delete(self):
+        a = self.load(title=u't', views=3)
+        del a.title
+        self.assertEqual(a.title, None)
+        self.assertFalse('title' in a._lazy.offsets)
+        self.assertEqual(a.get_update_dict(), {'$unset': {'title': 1}})
+
+class Session(mongopie.Model):
+    user = mongopie.StringField()
+    expires_at = mongopie.DateTimeField()
+    indexes = [mongopie.Index('user'),
+               mongopie.Index('expires_at', ttl=0)]
+
+class Legacy(mongopie.Model):
+    name = mongopie.StringField()
+    index_list = [('name', {})]
+
+class IndexTest(MockTestCase):
+    def test_sync(self):
+        self.assertEqual(sorted(Session.sync_indexes()['created']),
+                         ['expires_at_1', 'user_1'])
+        Session.collection().create_index('expires_at', name='other')
+        result = Session.sync_indexes(drop=True)
+        # mongomock does not keep the ttl of indexes
+        self.assertTrue('other' in result['dropped'])
+        self.assertFalse('user_1' in result['dropped'])
+
+    def test_ttl_zero_matches(self):
+        index = Session.indexes[1]
+        info = {'key': [('expires_at', 1)], 'expireAfterSeconds': 0}
+        self.assertTrue(index.matches(Session, info))
+        del info['expireAfterSeconds']
+        self.assertFalse(index.matches(Session, info))
+        info = {'key': [('user', 1)], 'unique': False}
+        self.assertTrue(Session.indexes[0].matches(Session, info))
+
+    def test_undeclared_models_kept(self):
+        Legacy.ensure_indices()
+        Article.collection().create_index('title')
+        result = mongopie.sync_all_indexes(drop=True)
+        self.assertFalse('Legacy' in result)
+        self.assertFalse('Article' in result)
+        self.assertTrue('title_1' in Article.collection().index_information())
+        self.assertEqual(Legacy.sync_indexes(drop=True)['dropped'], [])
+
+class SignalTest(MockTestCase):
+    def setUp(self):
+        super(SignalTest, self).setUp()
+        self.received = []
+        self.sent = []
+        slot = mongopie.modelsignal.post_create
+        self.index = slot.connect(Article, self.on_created)
+        send = slot.send
+        def counting_send(sender, **kw):
+            self.sent.append(sender)
+            return send(sender, **kw)
+        slot.send = counting_send
+
+    def tearDown(self):
+        slot = mongopie.modelsignal.post_create
+        del slot.send
+        slot.disconnect(Article, self.index)
+
+    def on_created(self, sender, instance=None, instances=None):
+        self.received.extend([instance] if instance else instances)
+
+    def test_handled_sender(self):
+        Article(title='a').save()
+        Article.bulk_save([Article(title='b'), Article(title='c')])
+        Article.bulk_save([Article(title='d')], signal='batch')
+        self.assertEqual([a.title for a in self.received],
+                         ['a', 'b', 'c', 'd'])
+
+    def test_sender_without_handlers(self):
+        self.assertTrue(mongopie.modelsignal.post_create.has_handlers(
+            Article))
+        self.assertFalse(mongopie.modelsignal.post_create.has_handlers(
+            Vote))
+        Vote(voter='tom').save()
+        Vote.bulk_save([Vote(voter='jerry'), Vote(voter='jack')])
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.received, [])
+
+class ObjectCacheTest(unittest.TestCase):
+    def test_options_merged(self):
+        class Expiring(mongopie.Model):
+            obj_cache_options = {'ttl': 60}
+        class Small(Expiring):
+            obj_cache_options = {'max_size': 10}
+        self.assertEqual(Expiring.obj_cache.ttl, 60)
+        self.assertEqual(Expiring.obj_cache.max_size, 10000)
+        self.assertTrue(isinstance(Expiring.obj_cache, mongopie.LRUCache))
+        self.assertEqual(Small.obj_cache.ttl, 60)
+        self.assertEqual(Small.obj_cache.max_size, 10)
+
+    def test_estimate_size_slots(self):
+        class Slotted(mongopie.Model):
+            use_slots = True
+            body = mongopie.StringField()
+        obj = Slotted(body='x' * 10000)
+        self.assertTrue(mongopie.estimate_size(obj) > 10000)
+
+class FailingBulk(object):
+    """ Bulk insert failing on its second document, mongomock raises
+    DuplicateKeyError instead of BulkWriteError
+    """
+    def __init__(self, col):
+        self.col = col
+        self.docs = []
+
+    def insert(self, doc):
+        self.docs.append(doc)
+
+    def execute(self):
+        for doc in self.docs[:1] + self.docs[2:]:
+            self.col.insert(doc)
+        raise BulkWriteError({
+            'writeErrors': [{'index': 1, 'code': 11000,
+                             'errmsg': 'duplicate key'}],
+            'nInserted': len(self.docs) - 1})
+
+class FailingCollection(object):
+    def __init__(self, col):
+        self.col = col
+
+    def __getattr__(self, name):
+        return getattr(self.col, name)
+
+    def initialize_unordered_bulk_op(self):
+        return FailingBulk(self.col)
+
+class WriteBehindTest(MockTestCase):
+    def wait_inserted(self, buf, count):
+        deadline = time.time() + 5
+        while buf.stats()['inserted'] < count and time.time() < deadline:
+            time.sleep(0.01)
+        return buf.stats()
+
+    def test_flush_max_size(self):
+        buf = mongopie.WriteBehindBuffer(Vote, max_size=3, max_age=60)
+        for i in xrange(3):
+            buf.add(Vote(voter='v%d' % i))
+        stats = self.wait_inserted(buf, 3)
+        self.assertEqual(stats['inserted'], 3)
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(Vote.find().count(), 3)
+
+    def test_flush_max_age(self):
+        buf = mongopie.WriteBehindBuffer(Vote, max_size=100, max_age=0.1)
+        buf.add(Vote(voter='v'))
+        self.assertEqual(buf.stats()['pending'], 1)
+        stats = self.wait_inserted(buf, 1)
+        self.assertEqual(stats['inserted'], 1)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_drop_without_block(self):
+        buf = mongopie.WriteBehindBuffer(Vote, max_size=2, max_age=60,
+                                         max_pending=2, block=False)
+        # Hold the flush until the buffer is full
+        with buf.flush_lock:
+            self.assertTrue(buf.add(Vote(voter='a')))
+            self.assertTrue(buf.add(Vote(voter='b')))
+            self.assertFalse(buf.add(Vote(voter='c')))
+        stats = self.wait_inserted(buf, 2)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['added'], 2)
+        self.assertEqual(sorted(v.voter for v in Vote.find()), ['a', 'b'])
+
+    def test_stats_bulk_write_error(self):
+        col = Vote.collection()
+        Vote.collection = classmethod(
+            lambda cls, **kwargs: FailingCollection(col))
+        try:
+            buf = mongopie.WriteBehindBuffer(Vote, max_size=100,
+                                             max_age=60)
+            votes = [Vote(voter='v%d' % i) for i in xrange(3)]
+            for v in votes:
+                buf.add(v)
+            result = buf.flush()
+        finally:
+            del Vote.collection
+        self.assertEqual(result.failed, 1)
+        stats = buf.stats()
+        self.assertEqual(stats['inserted'], 2)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['pending'], 0)
+        self.assertTrue(isinstance(buf.last_error, BulkWriteError))
+        self.assertTrue(votes[1].id is None)
+        self.assertEqual(Vote.find().count(), 2)
+
+class InvalidationBusTest(MockTestCase):
+    def setUp(self):
+        super(InvalidationBusTest, self).setUp()
+        # mongomock has no capped collections
+        db = mongopie.get_database(mongopie.default_db)
+        db.create_collection('mongopie_invalidation')
+        self.pub = mongopie.InvalidationBus(tailable=False)
+        self.sub = mongopie.InvalidationBus(tailable=False)
+        mongopie.set_invalidation_bus(self.pub)
+
+    def tearDown(self):
+        mongopie.set_invalidation_bus(None)
+
+    def test_publish_receive(self):
+        a = Article(title='t')
+        a.save()
+        # New objects are not cached anywhere
+        self.assertEqual(self.sub.poll(), 0)
+        a.title = 't2'
+        a.save()
+        # Cached again by the subscribing process
+        Article.obj_cache.set(a.id, a)
+        self.assertEqual(self.sub.poll(), 1)
+        self.assertFalse(a.id in Article.obj_cache)
+        self.assertEqual(self.pub.stats()['published'], 1)
+        self.assertEqual(self.sub.stats()['applied'], 1)
+
+    def test_class_eviction(self):
+        a = Article(title='t')
+        a.save()
+        self.sub.poll()
+        Article.obj_cache.set(a.id, a)
+        Vote.obj_cache.set(a.id, a)
+        # Not restricted to ids, the whole class is evicted
+        Article.remove(title='x')
+        self.assertEqual(self.sub.poll(), 1)
+        self.assertEqual(len(Article.obj_cache), 0)
+        self.assertTrue(a.id in Vote.obj_cache)
+
+    def test_reopened_cursor_skips_seen(self):
+        a = Article(title='t')
+        a.save()
+        self.sub.poll()
+        Article.invalidate_cache([a.id])
+        self.assertEqual(self.sub.poll(), 1)
+        # The reopened cursor starts a second earlier, messages
+        # already applied are skipped
+        Article.invalidate_cache([a.id])
+        self.assertEqual(self.sub.poll(), 1)
+        self.assertEqual(self.sub.stats(), {'published': 0,
+                                            'received': 2, 'applied': 2})
+        self.assertEqual(self.sub.poll(), 0)
+
+    def test_unchanged_save_not_published(self):
+        a = Article(title='t')
+        a.save()
+        Article.obj_cache.set(a.id, a)
+        for i in xrange(3):
+            a.save()
+        Article.bulk_save([a])
+        self.assertEqual(self.pub.stats()['published'], 0)
+        self.assertTrue(a.id in Article.obj_cache)
+
+    def test_own_messages_ignored(self):
+        a = Article(title='t')
+        a.save()
+        a.title = 't2'
+        a.save()
+        Article.obj_cache.set(a.id, a)
+        self.pub.poll()
+        self.assertTrue(a.id in Article.obj_cache)
+
+class AsyncTest(MockTestCase):
+    def setUp(self):
+        super(AsyncTest, self).setUp()
+        if mongopie.asyncio is None:
+            self.skipTest('asyncio or trollius is required')
+        self.loop = mongopie.asyncio.get_event_loop()
+
+    def run_future(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_run_async(self):
+        self.assertEqual(self.run_future(mongopie.run_async(sum, [1, 2])), 3)
+
+    def test_exception(self):
+        future = mongopie.run_async(Article.get, 123)
+        self.assertRaises(AssertionError, self.run_future, future)
+
+    def test_model_methods(self):
+        a = Article(title='t')
+        self.run_future(a.asave())
+        self.assertEqual(self.run_future(Article.aget(a.id)).title, 't')
+        self.assertEqual(self.run_future(Article.find().acount()), 1)
+        objs = self.run_future(Article.find().alist())
+        self.assertEqual([obj.id for obj in objs], [a.id])
+
+    def test_async_handler_awaited(self):
+        asyncio = mongopie.asyncio
+        done = []
+        @asyncio.coroutine
+        def on_created(sender, instance=None, **kw):
+            yield asyncio.sleep(0.01)
+            done.append(instance.title)
+        slot = mongopie.modelsignal.post_create
+        index = slot.connect(Article, on_created)
+        try:
+            self.run_future(Article(title='t').asave())
+        finally:
+            slot.disconnect(Article, index)
+        self.assertEqual(done, ['t'])
+
+if __name__ == '__main__':
+    unittest.main()
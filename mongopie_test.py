@@ -12,15 +12,10 @@ class UserTag(mongopie.Model):
 
     @classmethod
     def add_tag(cls, vote):
-        ut = cls.find_one(user=vote.votee,
-                          tag=vote.tag)
-        if not ut:
-            ut = cls()
-            ut.user = vote.votee
-            ut.tag = vote.tag
-        ut.count += 1
-        ut.save()
-        return ut            
+        # One atomic upsert instead of find_one and save
+        return cls.find(user=vote.votee,
+                        tag=vote.tag).update(inc={'count': 1},
+                                             upsert=True)
         
 class Vote(mongopie.Model):
     voter = mongopie.StringField()
@@ -45,6 +40,10 @@ def test():
     make_vote('Jerry', 'Jack', 'Hacking')
     for ut in UserTag.find(user='Jack').sort('tag').find(tag='Hacking')[0:1]:
         print ut.get_dict()
+    # Tally the tags on the server instead of loading every vote
+    for row in Vote.find(votee='Jack').group_by('tag', votes='count',
+                                                _sort='-votes'):
+        print row
 
 if __name__ == '__main__':
     test()